@@ -13,6 +13,8 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+
 from mautrix.bridge import Bridge
 from mautrix.bridge.state_store.asyncpg import PgBridgeStateStore
 from mautrix.types import RoomID, UserID
@@ -20,7 +22,7 @@ from mautrix.util.async_db import Database
 
 from .version import version, linkified_version
 from .config import Config
-from .db import upgrade_table, init as init_db
+from .db import upgrade_table, init as init_db, Receipt as DBReceipt
 from .matrix import MatrixHandler
 from .user import User
 from .portal import Portal
@@ -53,7 +55,7 @@ class MessagesBridge(Bridge):
 
     def prepare_db(self) -> None:
         self.db = Database(self.config["appservice.database"], upgrade_table=upgrade_table,
-                           loop=self.loop)
+                           db_args=self.config["appservice.database_opts"], loop=self.loop)
         init_db(self.db)
 
     def prepare_bridge(self) -> None:
@@ -64,21 +66,30 @@ class MessagesBridge(Bridge):
 
     async def start(self) -> None:
         await self.db.start()
-        await self.state_store.upgrade_table.upgrade(self.db.pool)
         User.init_cls(self)
         Puppet.init_cls(self)
         Portal.init_cls(self)
         if self.config["bridge.resend_bridge_info"]:
             self.add_startup_actions(self.resend_bridge_info())
-        main_user = await User.get_by_mxid(self.config["bridge.user"])
+        # The state store tables and the bridge user row are independent of each other
+        _, main_user = await asyncio.gather(
+            self.state_store.upgrade_table.upgrade(self.db.pool),
+            User.get_by_mxid(self.config["bridge.user"]))
         self.add_startup_actions(main_user.connect())
         await super().start()
 
     def prepare_stop(self) -> None:
-        self.add_shutdown_actions(user.stop() for user in User.by_mxid.values())
+        self.add_shutdown_actions(self._stop_users(), DBReceipt.flush())
         for puppet in Puppet.by_custom_mxid.values():
             puppet.stop()
 
+    async def _stop_users(self) -> None:
+        users = list(User.by_mxid.values())
+        results = await asyncio.gather(*(user.stop() for user in users), return_exceptions=True)
+        for user, result in zip(users, results):
+            if isinstance(result, Exception):
+                self.log.error(f"Failed to stop {user.mxid}", exc_info=result)
+
     async def resend_bridge_info(self) -> None:
         self.config["bridge.resend_bridge_info"] = False
         self.config.save()
@@ -13,19 +13,29 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, AsyncGenerator, Tuple, TYPE_CHECKING
+from typing import (Optional, AsyncGenerator, Awaitable, Callable, Dict, Mapping, Tuple,
+                    TYPE_CHECKING)
+from types import MappingProxyType
 import io
 
-import qrcode
-import PIL as _
-
-from mautrix.types import TextMessageEventContent, MediaMessageEventContent, MessageType, ImageInfo, EventID
+from mautrix.types import (TextMessageEventContent, MediaMessageEventContent, MessageType, ImageInfo,
+                           EventID, ContentURI)
 from mautrix.bridge.commands import HelpSection, command_handler
 
 from .typehint import CommandEvent
 
 SECTION_AUTH = HelpSection("Authentication", 10, "")
 
+QR_SCALE = 8
+QR_MESSAGE = "Open LINE on your smartphone and scan this QR code:"
+
+# mautrix's command processor reads command_status as a mapping (e.g. for "cancel"),
+# so keep it one, but share a read-only instance per login type instead of building new ones
+LOGIN_STATUSES: Mapping[str, Mapping[str, str]] = MappingProxyType({
+    login_type: MappingProxyType({"action": "Login", "login_type": login_type})
+    for login_type in ("qr", "email")
+})
+
 from ..db import LoginCredential
 
 if TYPE_CHECKING:
@@ -33,7 +43,7 @@ if TYPE_CHECKING:
 
 
 async def _login_prep(evt: CommandEvent, login_type: str) -> bool:
-    status = await evt.sender.client.start()
+    status = await evt.sender.start_status()
     if status.is_logged_in:
         await evt.reply("You're already logged in")
         return False
@@ -48,10 +58,7 @@ async def _login_prep(evt: CommandEvent, login_type: str) -> bool:
             await evt.reply(f"Cannot login while a {action} command is active.")
         return False
 
-    evt.sender.command_status = {
-        "action": "Login",
-        "login_type": login_type,
-    }
+    evt.sender.command_status = LOGIN_STATUSES[login_type]
     return True
 
 async def _login_do(
@@ -61,6 +68,8 @@ async def _login_do(
     sender: Optional["User"] = None,
 ) -> bool:
     qr_event_id: Optional[EventID] = None
+    qr_sent_mxc: Optional[ContentURI] = None
+    qr_cache: Dict[str, Tuple[ContentURI, int, int]] = {}
     pin_event_id: Optional[EventID] = None
     failure = False
 
@@ -77,48 +86,76 @@ async def _login_do(
             sender.log.warning("Cannot auto-loggin: must have a notice room to do so")
             return False
 
-    async for item in gen:
-        if item[0] == "qr":
-            message = "Open LINE on your smartphone and scan this QR code:"
-            content = TextMessageEventContent(body=message, msgtype=MessageType.NOTICE)
-            if evt:
-                content.set_reply(evt.event_id)
-            await az.intent.send_message(room_id, content)
-
-            url = item[1]
+    async def handle_qr(url: str) -> None:
+        nonlocal qr_event_id, qr_sent_mxc
+        try:
+            mxc, size, length = qr_cache[url]
+        except KeyError:
+            # Imported here so that bridges which never log in interactively don't pay for it
+            import segno
             buffer = io.BytesIO()
-            image = qrcode.make(url)
-            size = image.pixel_size
-            image.save(buffer, "PNG")
+            image = segno.make_qr(url, error="m")
+            size = image.symbol_size(scale=QR_SCALE)[0]
+            image.save(buffer, kind="png", scale=QR_SCALE)
             qr = buffer.getvalue()
-            mxc = await az.intent.upload_media(qr, "image/png", "login-qr.png", len(qr))
-            content = MediaMessageEventContent(body=url, url=mxc, msgtype=MessageType.IMAGE,
-                                               info=ImageInfo(mimetype="image/png", size=len(qr),
-                                                              width=size, height=size))
-            if qr_event_id:
-                content.set_edit(qr_event_id)
-                await az.intent.send_message(room_id, content)
-            else:
-                qr_event_id = await az.intent.send_message(room_id, content)
-        elif item[0] == "pin":
-            pin = item[1]
-            message = f"Enter this PIN in LINE on your smartphone:\n{pin}"
-            content = TextMessageEventContent(body=message, msgtype=MessageType.NOTICE)
-            if pin_event_id:
-                content.set_edit(pin_event_id)
-                await az.intent.send_message(room_id, content)
-            else:
-                pin_event_id = await az.intent.send_message(room_id, content)
-        elif item[0] == "login_success":
-            await az.intent.send_notice(room_id, "Successfully logged in, waiting for LINE to load...")
-        elif item[0] in ("login_failure", "error"):
-            # TODO Handle errors differently?
-            failure = True
-            reason = item[1]
-            if reason:
-                await az.intent.send_notice(room_id, reason)
-        # else: pass
+            length = len(qr)
+            # NOTE All intents of the appservice share its single keep-alive HTTP session,
+            #      so repeated uploads reuse pooled connections to the homeserver
+            mxc = await az.intent.upload_media(qr, "image/png", "login-qr.png", length)
+            qr_cache[url] = mxc, size, length
+        if mxc == qr_sent_mxc:
+            # LINE re-sent the QR code that is already being shown
+            return
+
+        content = MediaMessageEventContent(body=url, url=mxc, msgtype=MessageType.IMAGE,
+                                           info=ImageInfo(mimetype="image/png", size=length,
+                                                          width=size, height=size))
+        if qr_event_id:
+            # The instructions are still above the image, so only the image needs refreshing
+            content.set_edit(qr_event_id)
+            await az.intent.send_message(room_id, content)
+        else:
+            notice = TextMessageEventContent(body=QR_MESSAGE, msgtype=MessageType.NOTICE)
+            if evt:
+                notice.set_reply(evt.event_id)
+            await az.intent.send_message(room_id, notice)
+            qr_event_id = await az.intent.send_message(room_id, content)
+        qr_sent_mxc = mxc
+
+    async def handle_pin(pin: str) -> None:
+        nonlocal pin_event_id
+        message = f"Enter this PIN in LINE on your smartphone:\n{pin}"
+        content = TextMessageEventContent(body=message, msgtype=MessageType.NOTICE)
+        if pin_event_id:
+            content.set_edit(pin_event_id)
+            await az.intent.send_message(room_id, content)
+        else:
+            pin_event_id = await az.intent.send_message(room_id, content)
+
+    async def handle_success(_: None) -> None:
+        await az.intent.send_notice(room_id, "Successfully logged in, waiting for LINE to load...")
+
+    async def handle_failure(reason: Optional[str]) -> None:
+        nonlocal failure
+        # TODO Handle errors differently?
+        failure = True
+        if reason:
+            await az.intent.send_notice(room_id, reason)
+
+    handlers: Dict[str, Callable[[Optional[str]], Awaitable[None]]] = {
+        "qr": handle_qr,
+        "pin": handle_pin,
+        "login_success": handle_success,
+        "login_failure": handle_failure,
+        "error": handle_failure,
+    }
+    async for item in gen:
+        handler = handlers.get(item[0])
+        if handler:
+            await handler(item[1])
 
+    # Whatever the outcome, the login state has changed since the last start
+    sender.clear_start_status()
     login_success = not failure and sender.command_status
     if login_success:
         await az.intent.send_notice(room_id, "LINE loading complete")
@@ -166,7 +203,7 @@ async def login_email(evt: CommandEvent) -> None:
         await _save_password_helper(evt)
 
 async def auto_login(sender: "User") -> bool:
-    status = await sender.client.start()
+    status = await sender.start_status()
     if status.is_logged_in:
         return True
     if sender.command_status is not None:
@@ -174,10 +211,7 @@ async def auto_login(sender: "User") -> bool:
     creds = await LoginCredential.get_by_mxid(sender.mxid)
     if not creds:
         return False
-    sender.command_status = {
-        "action": "Login",
-        "login_type": "email",
-    }
+    sender.command_status = LOGIN_STATUSES["email"]
     gen = sender.client.login(
         sender,
         login_data={
@@ -198,13 +232,7 @@ async def save_password(evt: CommandEvent) -> None:
     await _save_password_helper(evt)
 
 async def _save_password_helper(evt: CommandEvent) -> None:
-    creds = await LoginCredential.get_by_mxid(evt.sender.mxid)
-    if creds:
-        creds.email = evt.args[0]
-        creds.password = evt.args[1]
-        await creds.update()
-    else:
-        await LoginCredential(evt.sender.mxid, email=evt.args[0], password=evt.args[1]).insert()
+    await LoginCredential(evt.sender.mxid, email=evt.args[0], password=evt.args[1]).save()
     await evt.reply("Login email/password saved, and will be used to log you back in if your LINE connection ends.")
 
 @command_handler(needs_auth=False, management_only=True, help_section=SECTION_AUTH,
@@ -31,7 +31,7 @@ async def set_notice_room(evt: CommandEvent) -> None:
 @command_handler(needs_auth=False, management_only=True, help_section=SECTION_CONNECTION,
                  help_text="Check if you're logged into LINE")
 async def ping(evt: CommandEvent) -> None:
-    status = await evt.sender.client.start()
+    status = await evt.sender.start_status()
     if status.is_logged_in:
         await evt.reply("You're logged in")
     elif status.is_permanently_disconnected or not status.is_connected:
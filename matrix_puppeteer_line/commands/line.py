@@ -13,6 +13,9 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Optional, Tuple
+import time
+
 from mautrix.bridge.commands import HelpSection, command_handler
 
 from .. import puppet as pu
@@ -20,15 +23,33 @@ from .typehint import CommandEvent
 
 SECTION_CHATS = HelpSection("Contacts & Chats", 40, "")
 
+CONTACTS_CACHE_TTL = 60
+
+# (puppet list version, creation time, formatted contact list)
+_contacts_cache: Optional[Tuple[int, float, str]] = None
+
+
+async def _get_contact_list() -> str:
+    global _contacts_cache
+    version = pu.Puppet.list_version
+    now = time.monotonic()
+    if (_contacts_cache and _contacts_cache[0] == version
+            and now - _contacts_cache[1] < CONTACTS_CACHE_TTL):
+        return _contacts_cache[2]
 
-@command_handler(needs_auth=True, management_only=False, help_section=SECTION_CHATS,
-                 help_text="List all LINE contacts")
-async def list_contacts(evt: CommandEvent) -> None:
     # TODO Use a generator if it's worth it
     puppets = await pu.Puppet.get_all()
     puppets.sort(key=lambda puppet: puppet.name)
     results = "".join(f"* [{puppet.name}](https://matrix.to/#/{puppet.default_mxid})\n"
                       for puppet in puppets)
+    _contacts_cache = (version, now, results)
+    return results
+
+
+@command_handler(needs_auth=True, management_only=False, help_section=SECTION_CHATS,
+                 help_text="List all LINE contacts")
+async def list_contacts(evt: CommandEvent) -> None:
+    results = await _get_contact_list()
     if results:
         await evt.reply(f"Contacts:\n\n{results}")
     else:
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Any, List, NamedTuple
+from functools import lru_cache
 import os
 
 from mautrix.util.config import ConfigUpdateHelper, ForbiddenDefault
@@ -22,12 +23,17 @@ from mautrix.bridge.config import BaseBridgeConfig
 Permissions = NamedTuple("Permissions", user=bool, admin=bool, level=str)
 
 
+@lru_cache(maxsize=256)
+def _env_key(key: str) -> str:
+    return f"matrix_puppeteer_line_{key.replace('.', '_').upper()}"
+
+
 class Config(BaseBridgeConfig):
     def __getitem__(self, key: str) -> Any:
-        try:
-            return os.environ[f"matrix_puppeteer_line_{key.replace('.', '_').upper()}"]
-        except KeyError:
-            return super().__getitem__(key)
+        value = os.environ.get(_env_key(key))
+        if value is not None:
+            return value
+        return super().__getitem__(key)
 
     @property
     def forbidden_defaults(self) -> List[ForbiddenDefault]:
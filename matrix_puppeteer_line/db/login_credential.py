@@ -13,7 +13,7 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, ClassVar, TYPE_CHECKING
+from typing import Optional, ClassVar, Dict, TYPE_CHECKING
 
 from attr import dataclass
 
@@ -23,9 +23,11 @@ from mautrix.util.async_db import Database
 fake_db = Database("") if TYPE_CHECKING else None
 
 
-@dataclass
+@dataclass(slots=True)
 class LoginCredential:
     db: ClassVar[Database] = fake_db
+    # Write-through cache, including misses, as the bridge is the only writer of this table
+    _by_mxid: ClassVar[Dict[UserID, Optional["LoginCredential"]]] = {}
 
     mxid: UserID
     email: str
@@ -35,20 +37,34 @@ class LoginCredential:
         q = ("INSERT INTO login_credential (mxid, email, password) "
              "VALUES ($1, $2, $3)")
         await self.db.execute(q, self.mxid, self.email, self.password)
+        self._by_mxid[self.mxid] = self
 
     async def update(self) -> None:
         await self.db.execute("UPDATE login_credential SET email=$2, password=$3 WHERE mxid=$1",
                               self.mxid, self.email, self.password)
+        self._by_mxid[self.mxid] = self
+
+    async def save(self) -> None:
+        q = ("INSERT INTO login_credential (mxid, email, password) "
+             "VALUES ($1, $2, $3) "
+             "ON CONFLICT (mxid) DO UPDATE SET email=EXCLUDED.email, password=EXCLUDED.password")
+        await self.db.execute(q, self.mxid, self.email, self.password)
+        self._by_mxid[self.mxid] = self
 
     @classmethod
     async def get_by_mxid(cls, mxid: UserID) -> Optional["LoginCredential"]:
+        try:
+            return cls._by_mxid[mxid]
+        except KeyError:
+            pass
         q = ("SELECT mxid, email, password "
              "FROM login_credential WHERE mxid=$1")
         row = await cls.db.fetchrow(q, mxid)
-        if not row:
-            return None
-        return cls(**row)
+        creds = cls(*row) if row else None
+        cls._by_mxid[mxid] = creds
+        return creds
 
     async def delete(self) -> None:
         await self.db.execute("DELETE FROM login_credential WHERE mxid=$1",
                               self.mxid)
+        self._by_mxid[self.mxid] = None
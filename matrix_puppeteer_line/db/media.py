@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Optional, ClassVar, TYPE_CHECKING
+from collections import OrderedDict
 
 from attr import dataclass
 
@@ -22,10 +23,16 @@ from mautrix.util.async_db import Database
 
 fake_db = Database("") if TYPE_CHECKING else None
 
+# media_id is already known by the caller, so only the remaining fields are fetched, in field order
+_Q_BY_ID = "SELECT mxc, mime_type, file_name, size FROM media WHERE media_id=$1"
 
-@dataclass
+
+@dataclass(slots=True)
 class Media:
     db: ClassVar[Database] = fake_db
+    # Most recently used media, kept so re-sent stickers/emoji don't hit the database again
+    _cache: ClassVar['OrderedDict[str, Media]'] = OrderedDict()
+    _cache_size: ClassVar[int] = 4096
 
     media_id: str
     mxc: ContentURI
@@ -37,17 +44,42 @@ class Media:
         q = ("INSERT INTO media (media_id, mxc, mime_type, file_name, size) "
              "VALUES ($1, $2, $3, $4, $5)")
         await self.db.execute(q, self.media_id, self.mxc, self.mime_type, self.file_name, self.size)
+        self._add_to_cache()
 
     async def update(self) -> None:
         q = ("UPDATE media SET mxc=$2 "
              "WHERE media_id=$1")
         await self.db.execute(q, self.media_id, self.mxc)
+        self._add_to_cache()
+
+    async def save(self) -> None:
+        # Insert or replace in one round-trip, e.g. when the same media was uploaded concurrently
+        q = ("INSERT INTO media (media_id, mxc, mime_type, file_name, size) "
+             "VALUES ($1, $2, $3, $4, $5) "
+             "ON CONFLICT (media_id) DO UPDATE "
+             "SET mxc=EXCLUDED.mxc, mime_type=EXCLUDED.mime_type, file_name=EXCLUDED.file_name, "
+             "    size=EXCLUDED.size")
+        await self.db.execute(q, self.media_id, self.mxc, self.mime_type, self.file_name, self.size)
+        self._add_to_cache()
+
+    def _add_to_cache(self) -> None:
+        self._cache[self.media_id] = self
+        self._cache.move_to_end(self.media_id)
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
 
     @classmethod
-    async def get_by_id(cls, media_id: str) -> Optional['DBMedia']:
-        q = ("SELECT media_id, mxc, mime_type, file_name, size "
-             "FROM media WHERE media_id=$1")
-        row = await cls.db.fetchrow(q, media_id)
+    async def get_by_id(cls, media_id: str) -> Optional['Media']:
+        try:
+            media = cls._cache[media_id]
+        except KeyError:
+            pass
+        else:
+            cls._cache.move_to_end(media_id)
+            return media
+        row = await cls.db.fetchrow(_Q_BY_ID, media_id)
         if not row:
             return None
-        return cls(**row)
+        media = cls(media_id, *row)
+        media._add_to_cache()
+        return media
@@ -13,7 +13,9 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, ClassVar, Dict, List, TYPE_CHECKING
+from typing import Optional, ClassVar, Dict, List, Tuple, TYPE_CHECKING
+from collections import OrderedDict
+import time
 
 from attr import dataclass
 
@@ -22,10 +24,27 @@ from mautrix.util.async_db import Database
 
 fake_db = Database("") if TYPE_CHECKING else None
 
+# asyncpg already prepares each query once per connection, caching it by query text,
+# so hot-path queries share module-level constants as in db/portal.py.
+_COLUMNS = "mxid, mx_room, mid, chat_id, is_outgoing"
+_Q_INSERT = f"INSERT INTO message ({_COLUMNS}) VALUES ($1, $2, $3, $4, $5)"
+_Q_BY_MXID = f"SELECT {_COLUMNS} FROM message WHERE mxid=$1 AND mx_room=$2"
+_Q_BY_MID = f"SELECT {_COLUMNS} FROM message WHERE mid=$1"
+_Q_BY_MIDS = f"SELECT {_COLUMNS} FROM message WHERE mid=ANY($1::bigint[])"
+# The lower bound is the latest message with a read receipt of the given count, if any
+_Q_ALL_SINCE_RECEIPT = (f"SELECT {_COLUMNS} FROM message WHERE chat_id=$1 AND mid<=$3 AND "
+                        "mid>COALESCE((SELECT mid FROM receipt WHERE chat_id=$1 AND num_read=$2), 0)")
+_Q_NEXT_NOID = f"SELECT {_COLUMNS} FROM message WHERE mid IS NULL AND mx_room=$1"
 
-@dataclass
+# Recent get_by_mid results, including misses, as every incoming message is first checked with it
+MID_CACHE_TTL = 30
+MID_CACHE_SIZE = 8192
+
+
+@dataclass(slots=True)
 class Message:
     db: ClassVar[Database] = fake_db
+    _by_mid: ClassVar['OrderedDict[int, Tuple[float, Optional[Message]]]'] = OrderedDict()
 
     mxid: Optional[EventID]
     mx_room: RoomID
@@ -34,36 +53,40 @@ class Message:
     is_outgoing: bool
 
     async def insert(self) -> None:
-        q = "INSERT INTO message (mxid, mx_room, mid, chat_id, is_outgoing) VALUES ($1, $2, $3, $4, $5)"
-        await self.db.execute(q, self.mxid, self.mx_room, self.mid, self.chat_id, self.is_outgoing)
+        await self.db.execute(_Q_INSERT, self.mxid, self.mx_room, self.mid, self.chat_id, self.is_outgoing)
+        if self.mid is not None:
+            self._cache_by_mid(self.mid, self)
 
     async def update_ids(self, new_mxid: EventID, new_mid: int) -> None:
         q = ("UPDATE message SET mxid=$1, mid=$2 "
              "WHERE mxid=$3 AND mx_room=$4 AND chat_id=$5")
         await self.db.execute(q, new_mxid, new_mid,
                               self.mxid, self.mx_room, self.chat_id)
+        self._by_mid.pop(new_mid, None)
+
+    @classmethod
+    def _cache_by_mid(cls, mid: int, msg: Optional['Message']) -> None:
+        cls._by_mid[mid] = (time.monotonic() + MID_CACHE_TTL, msg)
+        cls._by_mid.move_to_end(mid)
+        if len(cls._by_mid) > MID_CACHE_SIZE:
+            cls._by_mid.popitem(last=False)
 
     @classmethod
     async def get_max_mid(cls, room_id: RoomID) -> int:
-        return await cls.db.fetchval("SELECT MAX(mid) FROM message WHERE mx_room=$1", room_id)
+        # Unlike MAX(mid), this can be answered by descending the (mx_room, mid) index
+        return await cls.db.fetchval("SELECT mid FROM message WHERE mx_room=$1 AND mid IS NOT NULL "
+                                     "ORDER BY mid DESC LIMIT 1", room_id)
 
     @classmethod
     async def get_max_mids(cls) -> Dict[str, int]:
-        rows = await cls.db.fetch("SELECT chat_id, MAX(mid) AS max_mid "
-                                  "FROM message GROUP BY chat_id")
-        data = {}
-        for row in rows:
-            data[row["chat_id"]] = row["max_mid"]
-        return data
+        rows = await cls.db.fetch("SELECT chat_id, MAX(mid) FROM message GROUP BY chat_id")
+        return dict(rows)
 
     @classmethod
     async def get_max_outgoing_mids(cls) -> Dict[str, int]:
-        rows = await cls.db.fetch("SELECT chat_id, MAX(mid) AS max_mid "
+        rows = await cls.db.fetch("SELECT chat_id, MAX(mid) "
                                   "FROM message WHERE is_outgoing GROUP BY chat_id")
-        data = {}
-        for row in rows:
-            data[row["chat_id"]] = row["max_mid"]
-        return data
+        return dict(rows)
 
     @classmethod
     async def get_num_noid_msgs(cls, room_id: RoomID) -> int:
@@ -72,46 +95,56 @@ class Message:
 
     @classmethod
     async def is_last_by_mxid(cls, mxid: EventID, room_id: RoomID) -> bool:
-        q = ("SELECT mxid "
-             "FROM message INNER JOIN ( "
-             "    SELECT mx_room, MAX(mid) AS max_mid "
-             "    FROM message GROUP BY mx_room "
-             ") by_room "
-             "ON mid=max_mid "
-             "WHERE by_room.mx_room=$1")
+        q = ("SELECT mxid FROM message WHERE mx_room=$1 AND mid IS NOT NULL "
+             "ORDER BY mid DESC LIMIT 1")
         last_mxid = await cls.db.fetchval(q, room_id)
         return last_mxid == mxid
 
     @classmethod
     async def get_by_mxid(cls, mxid: EventID, mx_room: RoomID) -> Optional['Message']:
-        row = await cls.db.fetchrow("SELECT mxid, mx_room, mid, chat_id, is_outgoing "
-                                    "FROM message WHERE mxid=$1 AND mx_room=$2", mxid, mx_room)
+        row = await cls.db.fetchrow(_Q_BY_MXID, mxid, mx_room)
         if not row:
             return None
-        return cls(**row)
+        return cls(*row)
 
     @classmethod
     async def get_by_mid(cls, mid: int) -> Optional['Message']:
-        row = await cls.db.fetchrow("SELECT mxid, mx_room, mid, chat_id, is_outgoing FROM message WHERE mid=$1",
-                                    mid)
-        if not row:
-            return None
-        return cls(**row)
+        try:
+            expiry, msg = cls._by_mid[mid]
+        except KeyError:
+            pass
+        else:
+            if expiry > time.monotonic():
+                return msg
+        row = await cls.db.fetchrow(_Q_BY_MID, mid)
+        msg = cls(*row) if row else None
+        cls._cache_by_mid(mid, msg)
+        return msg
+
+    @classmethod
+    async def get_all_by_mids(cls, mids: List[int]) -> List['Message']:
+        # Like get_by_mid for many messages at once, and caches the misses as well
+        rows = await cls.db.fetch(_Q_BY_MIDS, mids)
+        msgs = [cls(*row) for row in rows]
+        found = {msg.mid: msg for msg in msgs}
+        for mid in mids:
+            cls._cache_by_mid(mid, found.get(mid))
+        return msgs
 
     @classmethod
-    async def get_all_since(cls, chat_id: str, min_mid: int, max_mid: int) -> List['Message']:
-        rows = await cls.db.fetch("SELECT mxid, mx_room, mid, chat_id, is_outgoing FROM message "
-                                  "WHERE chat_id=$1 AND $2<mid AND mid<=$3",
-                                  chat_id, min_mid, max_mid)
-        return [cls(**row) for row in rows]
+    async def get_all_since_receipt(cls, chat_id: str, num_read: int, max_mid: int
+                                    ) -> List['Message']:
+        # Messages after the latest one with num_read receipts, up to max_mid.
+        # Queued receipts must be flushed first for this to see them.
+        rows = await cls.db.fetch(_Q_ALL_SINCE_RECEIPT, chat_id, num_read, max_mid)
+        return [cls(*row) for row in rows]
 
     @classmethod
     async def get_next_noid_msg(cls, room_id: RoomID) -> Optional['Message']:
-        row = await cls.db.fetchrow("SELECT mxid, mx_room, mid, chat_id, is_outgoing FROM message "
-                                    "WHERE mid IS NULL AND mx_room=$1", room_id)
+        row = await cls.db.fetchrow(_Q_NEXT_NOID, room_id)
         if not row:
             return None
-        return cls(**row)
+        return cls(*row)
 
     @classmethod
     async def delete_all_noid_msgs(cls, room_id: RoomID) -> None:
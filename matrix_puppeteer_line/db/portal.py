@@ -13,7 +13,7 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, ClassVar, List, TYPE_CHECKING
+from typing import Optional, ClassVar, AsyncGenerator, TYPE_CHECKING
 
 from attr import dataclass
 
@@ -22,8 +22,24 @@ from mautrix.util.async_db import Database
 
 fake_db = Database("") if TYPE_CHECKING else None
 
+# Shared query texts, so that asyncpg's per-connection prepared statement cache
+# (which is keyed by the exact query string) reuses one statement per query.
+# Every SELECT returns exactly _COLUMNS, in field order, so rows can be passed positionally.
+_COLUMNS = "chat_id, other_user, mxid, name, icon_path, icon_mxc, encrypted, icon_hash"
+_Q_INSERT = (f"INSERT INTO portal ({_COLUMNS}) "
+             "VALUES ($1, $2, $3, $4, $5, $6, $7, $8)")
+_Q_UPDATE = ("UPDATE portal SET other_user=$2, mxid=$3, name=$4, "
+             "                  icon_path=$5, icon_mxc=$6, encrypted=$7, icon_hash=$8 "
+             "WHERE chat_id=$1")
+_Q_DELETE = "DELETE FROM portal WHERE chat_id=$1"
+_Q_BY_MXID = f"SELECT {_COLUMNS} FROM portal WHERE mxid=$1"
+_Q_BY_CHAT_ID = f"SELECT {_COLUMNS} FROM portal WHERE chat_id=$1"
+_Q_PRIVATE_CHATS = f"SELECT {_COLUMNS} FROM portal WHERE other_user IS NOT NULL"
+_Q_WITH_ROOM = f"SELECT {_COLUMNS} FROM portal WHERE mxid IS NOT NULL"
+_PREFETCH = 64
+
 
-@dataclass
+@dataclass(slots=True)
 class Portal:
     db: ClassVar[Database] = fake_db
 
@@ -34,54 +50,46 @@ class Portal:
     icon_path: Optional[str]
     icon_mxc: Optional[ContentURI]
     encrypted: bool
+    icon_hash: Optional[bytes]
 
     async def insert(self) -> None:
-        q = ("INSERT INTO portal (chat_id, other_user, mxid, name, icon_path, icon_mxc, encrypted) "
-             "VALUES ($1, $2, $3, $4, $5, $6, $7)")
-        await self.db.execute(q, self.chat_id, self.other_user, self.mxid, self.name,
+        await self.db.execute(_Q_INSERT, self.chat_id, self.other_user, self.mxid, self.name,
                               self.icon_path, self.icon_mxc,
-                              self.encrypted)
+                              self.encrypted, self.icon_hash)
 
     async def update(self) -> None:
-        q = ("UPDATE portal SET other_user=$2, mxid=$3, name=$4, "
-             "                  icon_path=$5, icon_mxc=$6, encrypted=$7 "
-             "WHERE chat_id=$1")
-        await self.db.execute(q, self.chat_id, self.other_user, self.mxid, self.name,
+        await self.db.execute(_Q_UPDATE, self.chat_id, self.other_user, self.mxid, self.name,
                               self.icon_path, self.icon_mxc,
-                              self.encrypted)
+                              self.encrypted, self.icon_hash)
 
     async def delete(self) -> None:
-        q = "DELETE FROM portal WHERE chat_id=$1"
-        await self.db.execute(q, self.chat_id)
+        await self.db.execute(_Q_DELETE, self.chat_id)
 
     @classmethod
     async def get_by_mxid(cls, mxid: RoomID) -> Optional['Portal']:
-        q = ("SELECT chat_id, other_user, mxid, name, icon_path, icon_mxc, encrypted "
-             "FROM portal WHERE mxid=$1")
-        row = await cls.db.fetchrow(q, mxid)
+        row = await cls.db.fetchrow(_Q_BY_MXID, mxid)
         if not row:
             return None
-        return cls(**row)
+        return cls(*row)
 
     @classmethod
     async def get_by_chat_id(cls, chat_id: str) -> Optional['Portal']:
-        q = ("SELECT chat_id, other_user, mxid, name, icon_path, icon_mxc, encrypted "
-             "FROM portal WHERE chat_id=$1")
-        row = await cls.db.fetchrow(q, chat_id)
+        row = await cls.db.fetchrow(_Q_BY_CHAT_ID, chat_id)
         if not row:
             return None
-        return cls(**row)
+        return cls(*row)
+
+    @classmethod
+    async def _iter(cls, q: str) -> AsyncGenerator['Portal', None]:
+        # Stream rows with a server-side cursor rather than materializing every portal at once
+        async with cls.db.acquire() as conn, conn.transaction():
+            async for row in conn.cursor(q, prefetch=_PREFETCH):
+                yield cls(*row)
 
     @classmethod
-    async def find_private_chats(cls) -> List['Portal']:
-        rows = await cls.db.fetch("SELECT chat_id, other_user, mxid, name, "
-                                  "       icon_path, icon_mxc, encrypted "
-                                  "FROM portal WHERE other_user IS NOT NULL")
-        return [cls(**row) for row in rows]
+    def find_private_chats(cls) -> AsyncGenerator['Portal', None]:
+        return cls._iter(_Q_PRIVATE_CHATS)
 
     @classmethod
-    async def all_with_room(cls) -> List['Portal']:
-        rows = await cls.db.fetch("SELECT chat_id, other_user, mxid, name, "
-                                  "       icon_path, icon_mxc, encrypted "
-                                  "FROM portal WHERE mxid IS NOT NULL")
-        return [cls(**row) for row in rows]
+    def all_with_room(cls) -> AsyncGenerator['Portal', None]:
+        return cls._iter(_Q_WITH_ROOM)
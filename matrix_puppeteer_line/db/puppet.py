@@ -22,8 +22,13 @@ from mautrix.util.async_db import Database
 
 fake_db = Database("") if TYPE_CHECKING else None
 
+_COLUMNS = "mid, name, avatar_path, avatar_mxc, name_set, avatar_set, is_registered"
+_Q_BY_MID = f"SELECT {_COLUMNS} FROM puppet WHERE mid=$1"
+_Q_BY_MIDS = f"SELECT {_COLUMNS} FROM puppet WHERE mid=ANY($1::text[])"
+_Q_ALL = f"SELECT {_COLUMNS} FROM puppet"
 
-@dataclass
+
+@dataclass(slots=True)
 class Puppet:
     db: ClassVar[Database] = fake_db
 
@@ -55,16 +60,17 @@ class Puppet:
 
     @classmethod
     async def get_by_mid(cls, mid: str) -> Optional['Puppet']:
-        q = ("SELECT mid, name, avatar_path, avatar_mxc, name_set, avatar_set, is_registered "
-             "FROM puppet WHERE mid=$1")
-        row = await cls.db.fetchrow(q, mid)
+        row = await cls.db.fetchrow(_Q_BY_MID, mid)
         if not row:
             return None
-        return cls(**row)
+        return cls(*row)
+
+    @classmethod
+    async def get_all_by_mids(cls, mids: List[str]) -> List['Puppet']:
+        rows = await cls.db.fetch(_Q_BY_MIDS, mids)
+        return [cls(*row) for row in rows]
 
     @classmethod
     async def get_all(cls) -> List['Puppet']:
-        q = ("SELECT mid, name, avatar_path, avatar_mxc, name_set, avatar_set, is_registered "
-             "FROM puppet")
-        rows = await cls.db.fetch(q)
-        return [cls(**row) for row in rows]
+        rows = await cls.db.fetch(_Q_ALL)
+        return [cls(*row) for row in rows]
@@ -13,7 +13,9 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import List, ClassVar, Dict, Optional, TYPE_CHECKING
+from typing import List, ClassVar, Dict, Optional, Tuple, TYPE_CHECKING
+import logging
+import asyncio
 
 from attr import dataclass
 
@@ -21,52 +23,91 @@ from mautrix.util.async_db import Database
 
 fake_db = Database("") if TYPE_CHECKING else None
 
+# Also delete lower counts for earlier messages, in the same round-trip.
+# The deleted rows never include the upserted one, as their num_read is lower.
+# TODO Consider using a CHECK for this instead
+_Q_INSERT_OR_UPDATE = ("WITH upsert AS ( "
+                       "    INSERT INTO receipt (mid, chat_id, num_read) "
+                       "    VALUES ($1, $2, $3) "
+                       "    ON CONFLICT (chat_id, num_read) "
+                       "    DO UPDATE SET mid=EXCLUDED.mid, num_read=EXCLUDED.num_read "
+                       ") "
+                       "DELETE FROM receipt "
+                       "WHERE chat_id=$2 AND mid<$1 AND num_read<$3")
+# How long queued receipts may wait for more to arrive before they are written
+FLUSH_DELAY = 0.25
 
-@dataclass
+
+@dataclass(slots=True)
 class Receipt:
     db: ClassVar[Database] = fake_db
+    log: ClassVar[logging.Logger] = logging.getLogger("mau.db.receipt")
+    # Receipts waiting to be written, keyed by (chat_id, num_read) so that floods coalesce
+    _pending: ClassVar[Dict[Tuple[str, int], int]] = {}
+    _flush_task: ClassVar[Optional[asyncio.Task]] = None
+    _flush_lock: ClassVar[Optional[asyncio.Lock]] = None
 
     mid: int
     chat_id: str
     num_read: int
 
     async def insert_or_update(self) -> None:
-        q = ("INSERT INTO receipt (mid, chat_id, num_read) "
-             "VALUES ($1, $2, $3) "
-             "ON CONFLICT (chat_id, num_read) "
-             "DO UPDATE SET mid=EXCLUDED.mid, num_read=EXCLUDED.num_read")
-        await self.db.execute(q, self.mid, self.chat_id, self.num_read)
+        await self.db.execute(_Q_INSERT_OR_UPDATE, self.mid, self.chat_id, self.num_read)
+
+    def insert_or_update_later(self) -> None:
+        # Receipts are only read back by this class, which flushes first, so they can be
+        # written in batches off the event handling path
+        self._pending[(self.chat_id, self.num_read)] = self.mid
+        if not self._flush_task or self._flush_task.done():
+            Receipt._flush_task = asyncio.get_event_loop().create_task(self._flush_later())
 
-        # Delete lower counts for earlier messages
-        # TODO Consider using a CHECK for this instead
-        q = ("DELETE FROM receipt "
-             "WHERE chat_id=$1 AND mid<$2 AND num_read<$3")
-        await self.db.execute(q, self.chat_id, self.mid, self.num_read)
+    @classmethod
+    async def _flush_later(cls) -> None:
+        await asyncio.sleep(FLUSH_DELAY)
+        await cls.flush()
 
     @classmethod
-    async def get_max_mid(cls, chat_id: str, num_read: int) -> Optional[int]:
-        q = ("SELECT mid FROM receipt "
-             "WHERE chat_id=$1 AND num_read=$2")
-        return await cls.db.fetchval(q, chat_id, num_read)
+    async def flush(cls) -> None:
+        if not cls._flush_lock:
+            Receipt._flush_lock = asyncio.Lock()
+        # Wait for any flush in progress, so that callers reading receipts back see its writes
+        async with cls._flush_lock:
+            await cls._flush()
+
+    @classmethod
+    async def _flush(cls) -> None:
+        if not cls._pending:
+            return
+        records = [(mid, chat_id, num_read) for (chat_id, num_read), mid in cls._pending.items()]
+        cls._pending.clear()
+        try:
+            async with cls.db.acquire() as conn:
+                await conn.executemany(_Q_INSERT_OR_UPDATE, records)
+            return
+        except Exception:
+            cls.log.debug("Failed to write %d read receipts at once, retrying one by one",
+                          len(records), exc_info=True)
+        for mid, chat_id, num_read in records:
+            try:
+                await cls.db.execute(_Q_INSERT_OR_UPDATE, mid, chat_id, num_read)
+            except Exception:
+                cls.log.exception("Failed to write read receipt for message %s read by %s",
+                                  mid, num_read)
 
     @classmethod
     async def get_max_mid_per_num_read(cls, chat_id: str) -> Dict[int, int]:
-        rows = await cls.db.fetch("SELECT chat_id, mid, num_read FROM receipt WHERE chat_id=$1", chat_id)
-        data = {}
-        for row in rows:
-            data[row["num_read"]] = row["mid"]
-        return data
+        await cls.flush()
+        rows = await cls.db.fetch("SELECT num_read, mid FROM receipt WHERE chat_id=$1", chat_id)
+        return dict(rows)
 
     @classmethod
     async def get_max_mids_per_num_read(cls) -> Dict[str, Dict[int, int]]:
-        rows = await cls.db.fetch("SELECT chat_id, mid, num_read FROM receipt")
+        await cls.flush()
+        rows = await cls.db.fetch("SELECT chat_id, num_read, mid FROM receipt")
         data = {}
-        for row in rows:
-            chat_id = row["chat_id"]
-            if chat_id not in data:
-                inner_data = {}
-                data[chat_id] = inner_data
-            else:
-                inner_data = data[chat_id]
-            inner_data[row["num_read"]] = row["mid"]
+        for chat_id, num_read, mid in rows:
+            try:
+                data[chat_id][num_read] = mid
+            except KeyError:
+                data[chat_id] = {num_read: mid}
         return data
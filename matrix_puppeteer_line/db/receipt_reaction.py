@@ -13,7 +13,7 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, ClassVar, TYPE_CHECKING, ClassVar
+from typing import Optional, ClassVar, List, TYPE_CHECKING
 
 from attr import dataclass
 
@@ -22,8 +22,13 @@ from mautrix.util.async_db import Database
 
 fake_db = Database("") if TYPE_CHECKING else None
 
+_COLUMNS = "mxid, mx_room, relates_to, num_read"
+_Q_BY_MXID = f"SELECT {_COLUMNS} FROM receipt_reaction WHERE mxid=$1 AND mx_room=$2"
+_Q_BY_RELATION = f"SELECT {_COLUMNS} FROM receipt_reaction WHERE relates_to=$1 AND mx_room=$2"
+_Q_BY_RELATIONS = f"SELECT {_COLUMNS} FROM receipt_reaction WHERE relates_to=ANY($1::text[]) AND mx_room=$2"
 
-@dataclass
+
+@dataclass(slots=True)
 class ReceiptReaction:
     db: ClassVar[Database] = fake_db
 
@@ -40,18 +45,26 @@ class ReceiptReaction:
         q = "DELETE FROM receipt_reaction WHERE mxid=$1 AND mx_room=$2"
         await self.db.execute(q, self.mxid, self.mx_room)
 
+    @classmethod
+    async def delete_many(cls, mxids: List[EventID], mx_room: RoomID) -> None:
+        q = "DELETE FROM receipt_reaction WHERE mxid=ANY($1::text[]) AND mx_room=$2"
+        await cls.db.execute(q, mxids, mx_room)
+
     @classmethod
     async def get_by_mxid(cls, mxid: EventID, mx_room: RoomID) -> Optional['ReceiptReaction']:
-        row = await cls.db.fetchrow("SELECT mxid, mx_room, relates_to, num_read "
-                                    "FROM receipt_reaction WHERE mxid=$1 AND mx_room=$2", mxid, mx_room)
+        row = await cls.db.fetchrow(_Q_BY_MXID, mxid, mx_room)
         if not row:
             return None
-        return cls(**row)
+        return cls(*row)
 
     @classmethod
     async def get_by_relation(cls, mxid: EventID, mx_room: RoomID) -> Optional['ReceiptReaction']:
-        row = await cls.db.fetchrow("SELECT mxid, mx_room, relates_to, num_read "
-                                    "FROM receipt_reaction WHERE relates_to=$1 AND mx_room=$2", mxid, mx_room)
+        row = await cls.db.fetchrow(_Q_BY_RELATION, mxid, mx_room)
         if not row:
             return None
-        return cls(**row)
+        return cls(*row)
+
+    @classmethod
+    async def get_all_by_relations(cls, mxids: List[EventID], mx_room: RoomID) -> List['ReceiptReaction']:
+        rows = await cls.db.fetch(_Q_BY_RELATIONS, mxids, mx_room)
+        return [cls(*row) for row in rows]
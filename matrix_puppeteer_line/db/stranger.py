@@ -16,14 +16,29 @@
 from typing import Optional, ClassVar, TYPE_CHECKING
 
 from attr import dataclass
-from random import randint, seed
+import os
 
 from mautrix.util.async_db import Database
 
 fake_db = Database("") if TYPE_CHECKING else None
 
+# asyncpg prepares each of these once per pooled connection and reuses the statement
+# on later calls with the same text, so only Bind/Execute is sent after the first use
+_COLUMNS = "fake_mid, name, avatar_path, available"
+_Q_INSERT = f"INSERT INTO stranger ({_COLUMNS}) VALUES ($1, $2, $3, $4)"
+_Q_UPDATE_PROFILE = "UPDATE stranger SET name=$2, avatar_path=$3 WHERE fake_mid=$1"
+_Q_MAKE_AVAILABLE = "UPDATE stranger SET available=true WHERE name=$1 AND avatar_path=$2"
+_Q_BY_MID = f"SELECT {_COLUMNS} FROM stranger WHERE fake_mid=$1"
+_Q_BY_PROFILE = f"SELECT {_COLUMNS} FROM stranger WHERE name=$1 AND avatar_path=$2"
+_Q_ANY_AVAILABLE = f"SELECT {_COLUMNS} FROM stranger WHERE available=true LIMIT 1"
+# Any available stranger, along with whichever of the candidate IDs are already taken
+_Q_AVAILABLE_OR_TAKEN = (f"({_Q_ANY_AVAILABLE}) UNION ALL "
+                         f"(SELECT {_COLUMNS} FROM stranger WHERE fake_mid=ANY($1::text[]))")
+# How many random IDs to check for collisions in a single query
+_NUM_CANDIDATES = 8
 
-@dataclass
+
+@dataclass(slots=True)
 class Stranger:
     db: ClassVar[Database] = fake_db
 
@@ -34,60 +49,46 @@ class Stranger:
     available: bool = False
 
     async def insert(self) -> None:
-        q = ("INSERT INTO stranger (fake_mid, name, avatar_path, available) "
-             "VALUES ($1, $2, $3, $4)")
-        await self.db.execute(q, self.fake_mid, self.name, self.avatar_path, self.available)
+        await self.db.execute(_Q_INSERT, self.fake_mid, self.name, self.avatar_path, self.available)
 
     async def update_profile_info(self) -> None:
-        q = ("UPDATE stranger SET name=$2, avatar_path=$3 "
-             "WHERE fake_mid=$1")
-        await self.db.execute(q, self.fake_mid, self.name, self.avatar_path)
+        await self.db.execute(_Q_UPDATE_PROFILE, self.fake_mid, self.name, self.avatar_path)
 
     async def make_available(self) -> None:
-        q = ("UPDATE stranger SET available=true "
-             "WHERE name=$1 AND avatar_path=$2")
-        await self.db.execute(q, self.name, self.avatar_path)
+        await self.db.execute(_Q_MAKE_AVAILABLE, self.name, self.avatar_path)
 
     @classmethod
     async def get_by_mid(cls, mid: str) -> Optional['Stranger']:
-        q = ("SELECT fake_mid, name, avatar_path, available "
-             "FROM stranger WHERE fake_mid=$1")
-        row = await cls.db.fetchrow(q, mid)
+        row = await cls.db.fetchrow(_Q_BY_MID, mid)
         if not row:
             return None
-        return cls(**row)
+        return cls(*row)
 
     @classmethod
     async def get_by_profile(cls, info: 'Participant') -> Optional['Stranger']:
-        q = ("SELECT fake_mid, name, avatar_path, available "
-             "FROM stranger WHERE name=$1 AND avatar_path=$2")
-        row = await cls.db.fetchrow(q, info.name, info.avatar.path if info.avatar else "")
+        row = await cls.db.fetchrow(_Q_BY_PROFILE, info.name, info.avatar.path if info.avatar else "")
         if not row:
             return None
-        return cls(**row)
+        return cls(*row)
 
     @classmethod
     async def get_any_available(cls) -> Optional['Stranger']:
-        q = ("SELECT fake_mid, name, avatar_path, available "
-             "FROM stranger WHERE available=true")
-        row = await cls.db.fetchrow(q)
+        row = await cls.db.fetchrow(_Q_ANY_AVAILABLE)
         if not row:
             return None
-        return cls(**row)
+        return cls(*row)
 
     @classmethod
     async def init_available_or_new(cls) -> 'Stranger':
-        stranger = await cls.get_any_available()
-        if not stranger:
-            while True:
-                fake_mid = "_STRANGER_"
-                for _ in range(32):
-                    fake_mid += f"{randint(0,15):x}"
-                if await cls.get_by_mid(fake_mid) != None:
-                    # Extremely unlikely event of a randomly-generated ID colliding with another.
-                    # If it happens, must be not that unlikely after all, so pick a new seed.
-                    seed()
-                else:
-                    stranger = cls(fake_mid)
-                    break
-        return stranger
\ No newline at end of file
+        while True:
+            candidates = [f"_STRANGER_{os.urandom(16).hex()}" for _ in range(_NUM_CANDIDATES)]
+            taken = set()
+            for row in await cls.db.fetch(_Q_AVAILABLE_OR_TAKEN, candidates):
+                if row[3]:
+                    return cls(*row)
+                taken.add(row[0])
+            fake_mid = next((mid for mid in candidates if mid not in taken), None)
+            # Every randomly-generated ID colliding with another is extremely unlikely,
+            # but if it happens, simply try again with new ones.
+            if fake_mid is not None:
+                return cls(fake_mid)
\ No newline at end of file
@@ -54,9 +54,8 @@ async def upgrade_avatars(conn: Connection) -> None:
        ADD COLUMN IF NOT EXISTS avatar_path TEXT,
        ADD COLUMN IF NOT EXISTS avatar_mxc TEXT,
        ADD COLUMN IF NOT EXISTS name_set BOOLEAN,
-       ADD COLUMN IF NOT EXISTS avatar_set BOOLEAN
-   """)
-    await conn.execute("""ALTER TABLE portal
+       ADD COLUMN IF NOT EXISTS avatar_set BOOLEAN;
+       ALTER TABLE portal
        ADD COLUMN IF NOT EXISTS icon_path TEXT,
        ADD COLUMN IF NOT EXISTS icon_mxc TEXT
    """)
@@ -72,20 +71,21 @@ async def upgrade_media(conn: Connection) -> None:
 
 @upgrade_table.register(description="Helpful table constraints")
 async def upgrade_table_constraints(conn: Connection) -> None:
+    # Check for both constraints in one round-trip, as queries on a connection can't overlap
+    q = ("SELECT EXISTS(SELECT FROM information_schema.constraint_table_usage "
+         "              WHERE table_name='portal' AND constraint_name='portal_mxid_key'), "
+         "       EXISTS(SELECT FROM information_schema.table_constraints "
+         "              WHERE table_name='message' AND constraint_name='message_chat_id_fkey')")
+    has_portal_constraint, has_message_constraint = await conn.fetchrow(q)
+
     table_name = "portal"
     constraint_name = f"{table_name}_mxid_key"
-    q = ( "SELECT EXISTS(SELECT FROM information_schema.constraint_table_usage "
-         f"WHERE table_name='{table_name}' AND constraint_name='{constraint_name}')")
-    has_constraint = await conn.fetchval(q)
-    if not has_constraint:
+    if not has_portal_constraint:
         await conn.execute(f"ALTER TABLE {table_name} ADD CONSTRAINT {constraint_name} UNIQUE(mxid)")
 
     table_name = "message"
     constraint_name = f"{table_name}_chat_id_fkey"
-    q = ( "SELECT EXISTS(SELECT FROM information_schema.table_constraints "
-         f"WHERE table_name='{table_name}' AND constraint_name='{constraint_name}')")
-    has_constraint = await conn.fetchval(q)
-    if not has_constraint:
+    if not has_message_constraint:
         await conn.execute(
         f"ALTER TABLE {table_name} ADD CONSTRAINT {constraint_name} "
             "FOREIGN KEY (chat_id) "
@@ -149,9 +149,9 @@ async def upgrade_noid_msgs(conn: Connection) -> None:
 
 @upgrade_table.register(description="Track LINE read receipts")
 async def upgrade_latest_read_receipts(conn: Connection) -> None:
-    await conn.execute("ALTER TABLE message DROP CONSTRAINT IF EXISTS message_mid_key")
-    await conn.execute("ALTER TABLE message ADD UNIQUE (mid, chat_id)")
     await conn.execute("ALTER TABLE message "
+                       "DROP CONSTRAINT IF EXISTS message_mid_key, "
+                       "ADD UNIQUE (mid, chat_id), "
                        "ADD COLUMN IF NOT EXISTS "
                        "is_outgoing BOOLEAN NOT NULL DEFAULT false")
 
@@ -182,4 +182,33 @@ async def upgrade_login_credentials(conn: Connection) -> None:
         FOREIGN KEY (mxid)
             REFERENCES "user" (mxid)
             ON DELETE CASCADE
-    )""")
\ No newline at end of file
+    )""")
+
+
+@upgrade_table.register(description="Index messages by room and ID")
+async def upgrade_message_room_mid_index(conn: Connection) -> None:
+    await conn.execute("CREATE INDEX IF NOT EXISTS message_mx_room_mid_idx "
+                       "ON message (mx_room, mid DESC)")
+
+
+@upgrade_table.register(description="Index messages that lack an ID")
+async def upgrade_message_noid_index(conn: Connection) -> None:
+    await conn.execute("CREATE INDEX IF NOT EXISTS message_noid_mx_room_idx "
+                       "ON message (mx_room) WHERE mid IS NULL")
+
+
+@upgrade_table.register(description="Index read receipt reactions by the message they react to")
+async def upgrade_receipt_reaction_relates_to_index(conn: Connection) -> None:
+    await conn.execute("CREATE INDEX IF NOT EXISTS receipt_reaction_mx_room_relates_to_idx "
+                       "ON receipt_reaction (mx_room, relates_to)")
+
+
+@upgrade_table.register(description="Index available strangers")
+async def upgrade_stranger_available_index(conn: Connection) -> None:
+    await conn.execute("CREATE INDEX IF NOT EXISTS stranger_available_idx "
+                       "ON stranger (fake_mid) WHERE available=true")
+
+
+@upgrade_table.register(description="Remember the content hash of portal icons")
+async def upgrade_portal_icon_hash(conn: Connection) -> None:
+    await conn.execute("ALTER TABLE portal ADD COLUMN IF NOT EXISTS icon_hash BYTEA")
@@ -23,7 +23,7 @@ from mautrix.util.async_db import Database
 fake_db = Database("") if TYPE_CHECKING else None
 
 
-@dataclass
+@dataclass(slots=True)
 class User:
     db: ClassVar[Database] = fake_db
 
@@ -46,7 +46,7 @@ class User:
         row = await cls.db.fetchrow(q, mxid)
         if not row:
             return None
-        return cls(**row)
+        return cls(*row)
 
     @classmethod
     async def discard_notice_room(cls, notice_room: RoomID) -> None:
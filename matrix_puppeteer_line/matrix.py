@@ -13,7 +13,8 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import TYPE_CHECKING
+from typing import Dict, Tuple, TYPE_CHECKING
+import asyncio
 
 from mautrix.bridge import BaseMatrixHandler
 from mautrix.types import (Event, EventType, MessageEvent, StateEvent, EncryptedEvent,
@@ -29,11 +30,16 @@ if TYPE_CHECKING:
 
 
 class MatrixHandler(BaseMatrixHandler):
+    # (user, room) pairs with a sync in progress, mapped to whether another was requested meanwhile
+    _pending_syncs: Dict[Tuple[UserID, RoomID], bool]
+
     def __init__(self, bridge: 'MessagesBridge') -> None:
-        prefix, suffix = bridge.config["bridge.username_template"].format(userid=":").split(":")
+        # Split on a character that can't be in the template, unlike ":"
+        prefix, suffix = bridge.config["bridge.username_template"].format(userid="\0").split("\0")
         homeserver = bridge.config["homeserver.domain"]
         self.user_id_prefix = f"@{prefix}"
         self.user_id_suffix = f"{suffix}:{homeserver}"
+        self._pending_syncs = {}
 
         super().__init__(bridge=bridge)
 
@@ -42,8 +48,11 @@ class MatrixHandler(BaseMatrixHandler):
             return False
         if not isinstance(evt, (MessageEvent, StateEvent, EncryptedEvent)):
             return True
-        return (evt.sender == self.az.bot_mxid
-                or pu.Puppet.get_id_from_mxid(evt.sender) is not None)
+        # Same check as Puppet.get_id_from_mxid, without parsing out the ID
+        sender = evt.sender
+        return (sender == self.az.bot_mxid
+                or (sender.startswith(self.user_id_prefix)
+                    and sender.endswith(self.user_id_suffix)))
 
     async def send_welcome_message(self, room_id: RoomID, inviter: 'u.User') -> None:
         await super().send_welcome_message(room_id, inviter)
@@ -57,12 +66,13 @@ class MatrixHandler(BaseMatrixHandler):
                                    invited_by: 'u.User', _: EventID) -> None:
         intent = puppet.intent
         self.log.debug(f"{invited_by.mxid} invited puppet for {puppet.mid} to {room_id}")
-        if not await invited_by.is_logged_in():
+        logged_in, portal = await asyncio.gather(invited_by.is_logged_in(),
+                                                 po.Portal.get_by_mxid(room_id))
+        if not logged_in:
             await intent.error_and_leave(room_id, text="Please log in before inviting "
                                                        "LINE puppets to private chats.")
             return
 
-        portal = await po.Portal.get_by_mxid(room_id)
         if portal:
             if portal.is_direct:
                 await intent.error_and_leave(room_id, text="You can not invite additional users "
@@ -74,20 +84,26 @@ class MatrixHandler(BaseMatrixHandler):
             return
 
         await intent.join_room(room_id)
+        # Look up the existing DM portal while the member list is being fetched,
+        # but only create one once the room is known to be usable for it.
+        portal_task = asyncio.create_task(po.Portal.get_by_chat_id(puppet.mid))
         try:
             members = await intent.get_room_members(room_id)
         except MatrixError:
             self.log.exception(f"Failed to get member list after joining {room_id}")
             await intent.leave_room(room_id)
+            await portal_task
             return
         if len(members) > 2:
             # TODO Add LINE group/room creating. Must also distinguish between the two!
             await intent.send_notice(room_id, "You can not invite LINE puppets to "
                                               "multi-user rooms.")
             await intent.leave_room(room_id)
+            await portal_task
             return
 
-        portal = await po.Portal.get_by_chat_id(puppet.mid, create=True)
+        portal = (await portal_task
+                  or await po.Portal.get_by_chat_id(puppet.mid, create=True))
         if portal.mxid:
             try:
                 await intent.invite_user(portal.mxid, invited_by.mxid, check_cache=False)
@@ -182,5 +198,20 @@ class MatrixHandler(BaseMatrixHandler):
         #if await DBMessage.is_last_by_mxid(event_id, portal.mxid):
 
         # Viewing a chat by updating it whole-hog, lest a ninja arrives
-        if not user.is_syncing:
-            await user.sync_portal(portal)
+        if user.is_syncing:
+            return
+        # Receipts tend to arrive in bursts, so fold them into the sync that's already
+        # running, plus at most one more to catch anything it may have missed.
+        key = (user.mxid, portal.mxid)
+        if key in self._pending_syncs:
+            self._pending_syncs[key] = True
+            return
+        self._pending_syncs[key] = False
+        try:
+            while True:
+                await user.sync_portal(portal)
+                if not self._pending_syncs[key]:
+                    break
+                self._pending_syncs[key] = False
+        finally:
+            del self._pending_syncs[key]
@@ -13,14 +13,18 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Dict, Optional, List, Set, Any, AsyncGenerator, NamedTuple, TYPE_CHECKING, cast
+from typing import (Dict, Optional, List, Set, Any, AsyncGenerator, Awaitable, Callable, NamedTuple,
+                    TYPE_CHECKING, cast)
 from asyncpg.exceptions import UniqueViolationError
-from html.parser import HTMLParser
+from html import unescape
 import mimetypes
+import hashlib
 import asyncio
+import time
+import re
 
 import magic
-from random import randint
+from tempfile import NamedTemporaryFile
 from os import remove
 
 from mautrix.appservice import AppService, IntentAPI
@@ -28,7 +32,7 @@ from mautrix.bridge import BasePortal, NotificationDisabler
 from mautrix.types import (EventID, MessageEventContent, RoomID, EventType, MessageType,
                            TextMessageEventContent, MediaMessageEventContent, Membership, Format,
                            ContentURI, EncryptedFile, ImageInfo,
-                           RelatesTo, RelationType)
+                           RelatesTo, RelationType, UserID)
 from mautrix.errors import IntentError
 from mautrix.errors.request import MatrixRequestError
 from mautrix.util.simple_lock import SimpleLock
@@ -49,29 +53,77 @@ except ImportError:
 
 StateBridge = EventType.find("m.bridge", EventType.Class.STATE)
 StateHalfShotBridge = EventType.find("uk.half-shot.bridge", EventType.Class.STATE)
+# How long a room that isn't a portal is remembered as such, to not query it on every event
+NOT_PORTAL_TTL = 60
+NOT_PORTAL_CACHE_SIZE = 4096
+# How many membership changes to have in flight at once when syncing participants
+MEMBER_SYNC_CONCURRENCY = 10
+# How many read receipts & receipt reactions to send or redact at once
+RECEIPT_CONCURRENCY = 10
+# How many stickers & emoticons to upload at once ahead of backfilling their messages
+MEDIA_PREFETCH_CONCURRENCY = 8
+# Message HTML is the innerHTML of LINE's own DOM, so it is well-formed enough to
+# tokenize directly rather than through an HTMLParser
+_HTML_TOKEN_RE = re.compile(r"<!--.*?-->|<[!?/][^>]*>|<([a-zA-Z][^\s/>]*)([^>]*)>|([^<]+|<)",
+                            re.S)
+_HTML_ATTR_RE = re.compile(r"""([^\s"'=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]*)))?""")
 MediaInfo = NamedTuple('MediaInfo', mxc=Optional[ContentURI],
                        decryption_info=Optional[EncryptedFile],
                        mime_type=str, file_name=str, size=int)
 
 
+def _sniff_mime_type(data: bytes) -> str:
+    return magic.from_buffer(data, mime=True)
+
+
+def _parse_html_attrs(attr_str: str) -> Dict[str, str]:
+    return {name.lower(): unescape(dq or sq or uq)
+            for name, dq, sq, uq in _HTML_ATTR_RE.findall(attr_str)}
+
+
+def _emoticon_media_id(attrs: Dict[str, str]) -> Optional[str]:
+    # Emoji are identified by their src, LINE emoticons by their package & sticker codes
+    if attrs.get("class") == "emojione":
+        return None
+    return f'{attrs.get("data-stickon-pkg-cd", 0)}/{attrs.get("data-stickon-stk-cd", 0)}'
+
+
 class Portal(DBPortal, BasePortal):
     invite_own_puppet_to_pm: bool = False
     by_mxid: Dict[RoomID, 'Portal'] = {}
     by_chat_id: Dict[str, 'Portal'] = {}
+    not_portal_mxids: Dict[RoomID, float] = {}
+    # Deduplicated media being reuploaded right now, so that concurrent messages
+    # with the same sticker or emoticon share one upload
+    media_uploads: Dict[str, 'asyncio.Task[Optional[MediaInfo]]'] = {}
+    # Portals being loaded or created right now, so that concurrent lookups share one instance
+    loading: Dict[str, 'asyncio.Task[Optional[Portal]]'] = {}
     config: Config
     matrix: 'm.MatrixHandler'
     az: AppService
 
+    # The kind of chat is fixed by the first character of its ID
+    is_direct: bool
+    is_group: bool
+    is_room: bool
+
     _main_intent: Optional[IntentAPI]
     _create_room_lock: asyncio.Lock
     backfill_lock: SimpleLock
     _last_participant_update: Set[str]
+    # Like _last_participant_update, but with unresolved profiles in place of stranger IDs
+    _last_participant_keys: Set[Any]
+    _cached_mxid: Optional[RoomID]
 
     def __init__(self, chat_id: str, other_user: Optional[str] = None,
                  mxid: Optional[RoomID] = None, name: Optional[str] = None,
                  icon_path: Optional[str] = None, icon_mxc: Optional[ContentURI] = None,
-                 encrypted: bool = False) -> None:
-        super().__init__(chat_id, other_user, mxid, name, icon_path, icon_mxc, encrypted)
+                 encrypted: bool = False, icon_hash: Optional[bytes] = None) -> None:
+        super().__init__(chat_id, other_user, mxid, name, icon_path, icon_mxc, encrypted,
+                         icon_hash)
+        self.is_direct = chat_id[0] == "u"
+        self.is_group = chat_id[0] == "c"
+        self.is_room = chat_id[0] == "r"
         self._create_room_lock = asyncio.Lock()
         self.log = self.log.getChild(str(chat_id))
 
@@ -79,18 +131,8 @@ class Portal(DBPortal, BasePortal):
                                         log=self.log)
         self._main_intent = None
         self._last_participant_update = set()
-
-    @property
-    def is_direct(self) -> bool:
-        return self.chat_id[0] == "u"
-
-    @property
-    def is_group(self) -> bool:
-        return self.chat_id[0] == "c"
-
-    @property
-    def is_room(self) -> bool:
-        return self.chat_id[0] == "r"
+        self._last_participant_keys = set()
+        self._cached_mxid = None
 
     @property
     def needs_bridgebot(self) -> bool:
@@ -134,6 +176,13 @@ class Portal(DBPortal, BasePortal):
         if num_noid_msgs > 0:
             self.log.warn(f"Found {num_noid_msgs} messages in chat {self.chat_id} with no ID that could not be matched with a real ID")
 
+    @staticmethod
+    def _write_temp_file(data: bytes, suffix: Optional[str]) -> str:
+        with NamedTemporaryFile(dir="/dev/shm", prefix="file_", suffix=suffix,
+                                delete=False) as temp_file:
+            temp_file.write(data)
+        return temp_file.name
+
     async def handle_matrix_message(self, sender: 'u.User', message: MessageEventContent,
                                     event_id: EventID) -> None:
         if not await sender.is_logged_in():
@@ -157,22 +206,29 @@ class Portal(DBPortal, BasePortal):
         elif message.msgtype.is_media:
             if message.file and decrypt_attachment:
                 data = await self.main_intent.download_media(message.file.url)
-                data = decrypt_attachment(data, message.file.key.key,
-                                          message.file.hashes.get("sha256"), message.file.iv)
+                # AES over a whole file takes a while, so keep it off the event loop
+                data = await self.loop.run_in_executor(
+                    None, decrypt_attachment, data, message.file.key.key,
+                    message.file.hashes.get("sha256"), message.file.iv)
             else:
                 data = await self.main_intent.download_media(message.url)
-            mime_type = message.info.mimetype or magic.from_buffer(data, mime=True)
+            mime_type = (message.info.mimetype
+                         or await self.loop.run_in_executor(None, _sniff_mime_type, data))
 
+            # Puppeteer can only upload files from a path, so the data has to hit the disk
             # TODO Set path from config
-            file_path = f"/dev/shm/file_{randint(0,1000)}{mimetypes.guess_extension(mime_type)}"
-            temp_file = open(file_path, 'wb')
-            temp_file.write(data)
+            file_path = await self.loop.run_in_executor(
+                None, self._write_temp_file, data, mimetypes.guess_extension(mime_type))
+            # The file is all that's needed from here on, so don't hold on to another copy
+            # of it in memory for as long as the upload takes
+            del data
             try:
                 message_id = await sender.client.send_file(self.chat_id, file_path)
             except RPCError as e:
                 self.log.warning(f"Failed to upload media {event_id} to chat {self.chat_id}: {e}")
                 message_id = -1
-            remove(file_path)
+            finally:
+                await self.loop.run_in_executor(None, remove, file_path)
 
         await self._cleanup_noid_msgs()
         msg = None
@@ -253,6 +309,8 @@ class Portal(DBPortal, BasePortal):
                 await intent.ensure_joined(self.mxid)
 
         if evt.id:
+            # NOTE Preseen messages can't be matched to their IDs in bulk, as each one's Matrix event
+            #      must be redacted or edited before its new mxid (and thus its row) is known
             msg = await DBMessage.get_next_noid_msg(self.mxid)
             if not msg:
                 self.log.info(f"Handling new message {evt.id} in chat {self.mxid}")
@@ -314,58 +372,55 @@ class Portal(DBPortal, BasePortal):
                     content.set_edit(prev_event_id)
                 event_id = await self._send_message(intent, content, timestamp=evt.timestamp)
         elif evt.html and not evt.html.isspace():
-
-            chunks = []
-
-            def handle_data(data):
-                nonlocal chunks
-                chunks.append({"type": "data", "data": data})
-
-            def handle_starttag(tag, attrs):
-                obj = {"type": tag}
-                for attr in attrs:
-                    obj[attr[0]] = attr[1]
-                nonlocal chunks
-                chunks.append(obj)
-
-            parser = HTMLParser()
-            parser.handle_data = handle_data
-            parser.handle_starttag = handle_starttag
-            parser.feed(evt.html)
-
-            msg_text = ""
-            msg_html = None
-
-            for chunk in chunks:
-                ctype = chunk["type"]
-                if ctype == "br":
-                    msg_text += "\n"
-                    if not msg_html:
-                        msg_html = msg_text
-                    msg_html += "<br>"
-                elif ctype == "data":
-                    msg_text += chunk["data"]
-                    if msg_html:
-                        msg_html += chunk["data"]
-                elif ctype == "img":
-                    height = int(chunk.get("height", 19)) * self.emoji_scale_factor
-                    cclass = chunk["class"]
+            # Built up as lists of parts and joined at the end, rather than by repeated
+            # concatenation. html_parts starts out as a copy of text_parts once it's needed.
+            html_parts = None
+            if "<" not in evt.html:
+                # Most messages are plain text, which has nothing to tokenize
+                text_parts = [unescape(evt.html)]
+                tokens = ()
+            else:
+                text_parts = []
+                tokens = _HTML_TOKEN_RE.finditer(evt.html)
+
+            for match in tokens:
+                tag, attr_str, data = match.groups()
+                if data is not None:
+                    data = unescape(data)
+                    text_parts.append(data)
+                    if html_parts is not None:
+                        html_parts.append(data)
+                    continue
+                if not tag:
+                    # End tags, comments and declarations
+                    continue
+                tag = tag.lower()
+                if tag == "br":
+                    text_parts.append("\n")
+                    if html_parts is None:
+                        html_parts = text_parts.copy()
+                    html_parts.append("<br>")
+                elif tag == "img":
+                    attrs = _parse_html_attrs(attr_str)
+                    height = int(attrs.get("height", 19)) * self.emoji_scale_factor
+                    cclass = attrs["class"]
                     if cclass == "emojione":
-                        alt = chunk["alt"]
-                        media_id = None
+                        alt = attrs["alt"]
                     else:
-                        alt = "".join(filter(lambda char: char.isprintable(), chunk["alt"])).strip()
+                        alt = "".join(filter(lambda char: char.isprintable(), attrs["alt"])).strip()
                         alt = f':{alt if alt else "n/a"}:'
-                        media_id = f'{chunk.get("data-stickon-pkg-cd", 0)}/{chunk.get("data-stickon-stk-cd", 0)}'
+                    media_id = _emoticon_media_id(attrs)
 
                     # NOTE Not encrypting content linked to by HTML tags
                     if not self.encrypted and self.config["bridge.receive_stickers"]:
-                        media_info = await self._handle_remote_media(source, intent, chunk["src"], media_id, deduplicate=True)
-                        if not msg_html:
-                            msg_html = msg_text
-                        msg_html += f'<img data-mx-emoticon src="{media_info.mxc}" alt="{alt}" title="{alt}" height="{height}">'
-                    msg_text += alt
-
+                        media_info = await self._handle_remote_media(source, intent, attrs["src"], media_id, deduplicate=True)
+                        if html_parts is None:
+                            html_parts = text_parts.copy()
+                        html_parts.append(f'<img data-mx-emoticon src="{media_info.mxc}" alt="{alt}" title="{alt}" height="{height}">')
+                    text_parts.append(alt)
+
+            msg_text = "".join(text_parts)
+            msg_html = "".join(html_parts) if html_parts is not None else None
             content = TextMessageEventContent(
                 msgtype=MessageType.TEXT,
                 format=Format.HTML if msg_html else None,
@@ -417,71 +472,119 @@ class Portal(DBPortal, BasePortal):
         else:
             # Update receipts not only for this message, but also for
             # all messages before it with an equivalent "read by" count.
-            prev_receipt_id = await DBReceipt.get_max_mid(self.chat_id, receipt_count) or 0
-            messages = await DBMessage.get_all_since(self.chat_id, prev_receipt_id, receipt_id)
+            await DBReceipt.flush()
+            messages = await DBMessage.get_all_since_receipt(self.chat_id, receipt_count, receipt_id)
 
             # Remove reactions for outdated "read by" counts.
-            for message in messages:
-                reaction = await DBReceiptReaction.get_by_relation(message.mxid, self.mxid)
-                if reaction:
-                    await self.main_intent.redact(self.mxid, reaction.mxid)
-                    await reaction.delete()
+            reactions = await DBReceiptReaction.get_all_by_relations(
+                [message.mxid for message in messages if message.mxid], self.mxid)
+            sema = asyncio.Semaphore(RECEIPT_CONCURRENCY)
+            if reactions:
+                async def redact(reaction: DBReceiptReaction) -> None:
+                    async with sema:
+                        await self.main_intent.redact(self.mxid, reaction.mxid)
+
+                # Only forget the reactions that were actually redacted
+                results = await asyncio.gather(*(redact(reaction) for reaction in reactions),
+                                               return_exceptions=True)
+                redacted = []
+                for reaction, result in zip(reactions, results):
+                    if result is None:
+                        redacted.append(reaction.mxid)
+                    else:
+                        self.log.warning(f"Failed to redact read receipt reaction {reaction.mxid} "
+                                         f"in {self.chat_id}: {result}")
+                if redacted:
+                    await DBReceiptReaction.delete_many(redacted, self.mxid)
 
             # If there are as many receipts as there are chat participants, then everyone
             # must have read the message, so send real read receipts from each puppet.
             # TODO Not just -1 if there are multiple _OWN_ puppets...
             is_fully_read = receipt_count >= len(self._last_participant_update) - 1
             if is_fully_read:
-                for mid in filter(lambda mid: not p.Puppet.is_mid_for_own_puppet(mid), self._last_participant_update):
-                    intent = (await p.Puppet.get_by_mid(mid)).intent
-                    await intent.send_receipt(self.mxid, event_id)
+                async def send_receipt(mid: str) -> None:
+                    async with sema:
+                        intent = (await p.Puppet.get_by_mid(mid)).intent
+                        await intent.send_receipt(self.mxid, event_id)
+
+                puppet_mids = [mid for mid in self._last_participant_update
+                               if not p.Puppet.is_mid_for_own_puppet(mid)]
+                results = await asyncio.gather(*(send_receipt(mid) for mid in puppet_mids),
+                                               return_exceptions=True)
+                for result in results:
+                    if isinstance(result, Exception):
+                        self.log.warning(f"Failed to send read receipt in chat {self.chat_id}: {result}")
             else:
-                # TODO messages list should exclude non-outgoing messages,
-                #     but include them just to get rid of potential stale reactions
-                for message in (msg for msg in messages if msg.is_outgoing):
+                async def react(message: DBMessage) -> None:
                     # TODO Translatable string for "Read by"
                     try:
-                        reaction_mxid = await self.main_intent.react(self.mxid, message.mxid, f"(Read by {receipt_count})")
+                        async with sema:
+                            reaction_mxid = await self.main_intent.react(self.mxid, message.mxid, f"(Read by {receipt_count})")
                         await DBReceiptReaction(reaction_mxid, self.mxid, message.mxid, receipt_count).insert()
                     except Exception as e:
                         self.log.warning(f"Failed to send read receipt reaction for message {message.mxid} in {self.chat_id}: {e}")
 
-        try:
-            await DBReceipt(mid=receipt_id, chat_id=self.chat_id, num_read=receipt_count).insert_or_update()
-            self.log.debug(f"Handled read receipt for message {receipt_id} read by {receipt_count}")
-        except Exception as e:
-            self.log.debug(f"Failed to handle read receipt for message {receipt_id} read by {receipt_count}: {e}")
+                # TODO messages list should exclude non-outgoing messages,
+                #     but include them just to get rid of potential stale reactions
+                await asyncio.gather(*(react(msg) for msg in messages if msg.is_outgoing))
+
+        DBReceipt(mid=receipt_id, chat_id=self.chat_id, num_read=receipt_count).insert_or_update_later()
+        self.log.debug(f"Handled read receipt for message {receipt_id} read by {receipt_count}")
 
     async def _handle_remote_media(self, source: 'u.User', intent: IntentAPI,
                                         media_url: str, media_id: Optional[str] = None,
                                         deduplicate: bool = False) -> MediaInfo:
         if not media_id:
             media_id = media_url
-        db_media_info = await DBMedia.get_by_id(media_id) if deduplicate else None
-        if not db_media_info:
-            # NOTE Blob URL of stickers only persists for a single session...still better than nothing.
-            self.log.debug(f"{'Did not find existing mxc URL for' if deduplicate else 'Not deduplicating'} {media_id}, uploading media now")
-            try:
-                resp = await source.client.read_image(media_url)
-            except (RPCError, TypeError) as e:
-                self.log.warning(f"Failed to download remote media from chat {self.chat_id}: {e}")
-                return None
-            media_info = await self._reupload_remote_media(resp.data, intent, resp.mime, disable_encryption=deduplicate)
-            if deduplicate:
-                await DBMedia(
-                    media_id=media_id, mxc=media_info.mxc,
-                    size=media_info.size, mime_type=media_info.mime_type, file_name=media_info.file_name
-                    ).insert()
-            return media_info
-        else:
+        if not deduplicate:
+            self.log.debug(f"Not deduplicating {media_id}, uploading media now")
+            return await self._download_and_reupload_media(source, intent, media_url)
+
+        db_media_info = await DBMedia.get_by_id(media_id)
+        if db_media_info:
             self.log.debug(f"Found existing mxc URL for {media_id}: {db_media_info.mxc}")
             return MediaInfo(db_media_info.mxc, None, db_media_info.mime_type, db_media_info.file_name, db_media_info.size)
 
+        try:
+            upload = self.media_uploads[media_id]
+            self.log.debug(f"Waiting for in-progress upload of {media_id}")
+        except KeyError:
+            # NOTE Blob URL of stickers only persists for a single session...still better than nothing.
+            self.log.debug(f"Did not find existing mxc URL for {media_id}, uploading media now")
+            upload = self.loop.create_task(
+                self._upload_deduplicated_media(source, intent, media_url, media_id))
+            self.media_uploads[media_id] = upload
+            upload.add_done_callback(lambda _: self.media_uploads.pop(media_id, None))
+        # Shielded so that one waiter being cancelled doesn't cancel the upload for the rest
+        return await asyncio.shield(upload)
+
+    async def _upload_deduplicated_media(self, source: 'u.User', intent: IntentAPI,
+                                         media_url: str, media_id: str) -> Optional[MediaInfo]:
+        media_info = await self._download_and_reupload_media(source, intent, media_url,
+                                                             disable_encryption=True)
+        if media_info:
+            await DBMedia(
+                media_id=media_id, mxc=media_info.mxc,
+                size=media_info.size, mime_type=media_info.mime_type, file_name=media_info.file_name
+                ).save()
+        return media_info
+
+    async def _download_and_reupload_media(self, source: 'u.User', intent: IntentAPI,
+                                           media_url: str, disable_encryption: bool = False
+                                           ) -> Optional[MediaInfo]:
+        try:
+            resp = await source.client.read_image(media_url)
+        except (RPCError, TypeError) as e:
+            self.log.warning(f"Failed to download remote media from chat {self.chat_id}: {e}")
+            return None
+        return await self._reupload_remote_media(resp.data, intent, resp.mime,
+                                                 disable_encryption=disable_encryption)
+
     async def _reupload_remote_media(self, data: bytes, intent: IntentAPI,
                                      mime_type: str = None, file_name: str = None,
                                      disable_encryption: bool = True) -> MediaInfo:
         if not mime_type:
-            mime_type = magic.from_buffer(data, mime=True)
+            mime_type = await self.loop.run_in_executor(None, _sniff_mime_type, data)
         upload_mime_type = mime_type
         if not file_name:
             file_name = f"image{mimetypes.guess_extension(mime_type)}"
@@ -489,7 +592,7 @@ class Portal(DBPortal, BasePortal):
 
         decryption_info = None
         if self.encrypted and encrypt_attachment and not disable_encryption:
-            data, decryption_info = encrypt_attachment(data)
+            data, decryption_info = await self.loop.run_in_executor(None, encrypt_attachment, data)
             upload_mime_type = "application/octet-stream"
             upload_file_name = None
 
@@ -506,12 +609,26 @@ class Portal(DBPortal, BasePortal):
         return MediaInfo(mxc, decryption_info, mime_type, file_name, len(data))
 
     async def update_info(self, conv: ChatInfo, client: Optional[Client]) -> None:
+        sema = asyncio.Semaphore(MEMBER_SYNC_CONCURRENCY)
+
+        async def update_puppet(info: Participant) -> None:
+            async with sema:
+                puppet = await p.Puppet.get_by_mid(info.id, client)
+                await puppet.update_info(info, client)
+
+        # REMINDER: multi-user chats include your own LINE user in the participant list
+        results = await asyncio.gather(*(update_puppet(participant)
+                                         for participant in conv.participants
+                                         if participant.id != None),
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.log.warning(f"Failed to update participant of chat {self.chat_id}: {result}")
+
+        # Participants without an ID are matched by profile, which must be done one at a time
+        # for a profile that appears twice to resolve to the same stranger
         for participant in conv.participants:
-            # REMINDER: multi-user chats include your own LINE user in the participant list
-            if participant.id != None:
-                puppet = await p.Puppet.get_by_mid(participant.id, client)
-                await puppet.update_info(participant, client)
-            else:
+            if participant.id == None:
                 self.log.warning(f"Could not find ID of LINE user {participant.name}")
                 puppet = await p.Puppet.get_by_profile(participant, client)
 
@@ -556,8 +673,16 @@ class Portal(DBPortal, BasePortal):
                     self.log.error(f"Cannot update room icon: no connection to LINE")
                     return
                 resp = await client.read_image(icon.url)
+                # LINE may serve the same icon under a new path, which needn't be reuploaded
+                icon_hash = hashlib.sha256(resp.data).digest()
+                if icon_hash == self.icon_hash and self.icon_mxc:
+                    self.log.debug(f"Room icon of {self.name or self.chat_id} changed path "
+                                   "but not content, not reuploading it")
+                    return True
+                self.icon_hash = icon_hash
                 self.icon_mxc = await self.main_intent.upload_media(resp.data, mime_type=resp.mime)
             else:
+                self.icon_hash = None
                 self.icon_mxc = ContentURI("")
             if self.mxid:
                 try:
@@ -573,33 +698,49 @@ class Portal(DBPortal, BasePortal):
         if not self.mxid:
             return
 
-        # Store the current member list to prevent unnecessary updates
+        # Store the current member list to prevent unnecessary updates.
+        # Compare by profile for users without an ID, to only look up their strangers if needed.
+        current_keys = {participant.id if participant.id != None else
+                        (participant.name, participant.avatar.path if participant.avatar else "")
+                        for participant in participants}
+        if current_keys == self._last_participant_keys:
+            self.log.trace("Not updating participants: list matches cached list")
+            return
+
         current_members = set()
         for participant in participants:
             current_members.add(
                 participant.id if participant.id != None else \
                 (await p.Puppet.get_by_profile(participant)).mid)
-
-        if current_members == self._last_participant_update:
-            self.log.trace("Not updating participants: list matches cached list")
-            return
+        self._last_participant_keys = current_keys
         self._last_participant_update = current_members
+        self.log.trace("Updating participants: %s", current_members)
 
         # TODO When supporting multiple bridge users, do this per user
         forbid_own_puppets = \
             not self.invite_own_puppet_to_pm or \
             (await u.User.get_by_mxid(self.config["bridge.user"], False)).intent is not None
 
+        sema = asyncio.Semaphore(MEMBER_SYNC_CONCURRENCY)
+
         # Make sure puppets who should be here are here
-        for participant in participants:
-            if forbid_own_puppets and p.Puppet.is_mid_for_own_puppet(participant.id):
-                continue
-            intent = (await p.Puppet.get_by_sender(participant)).intent
-            await intent.ensure_joined(self.mxid)
+        async def ensure_joined(participant: Participant) -> None:
+            async with sema:
+                intent = (await p.Puppet.get_by_sender(participant)).intent
+                await intent.ensure_joined(self.mxid)
 
-        print(current_members)
+        await asyncio.gather(*(ensure_joined(participant) for participant in participants
+                               if not (forbid_own_puppets
+                                       and p.Puppet.is_mid_for_own_puppet(participant.id))))
 
         # Puppets who shouldn't be here should leave
+        async def leave(user_id: UserID) -> None:
+            self.log.trace("Removing stale puppet %s", user_id)
+            async with sema:
+                puppet = await p.Puppet.get_by_mxid(user_id)
+                await puppet.intent.leave_room(self.mxid)
+
+        to_leave = []
         for user_id in await self.main_intent.get_room_members(self.mxid):
             if user_id == self.az.bot_mxid:
                 if forbid_own_puppets and not self.needs_bridgebot:
@@ -610,9 +751,8 @@ class Portal(DBPortal, BasePortal):
             is_own_puppet = p.Puppet.is_mid_for_own_puppet(mid)
             if mid and mid not in current_members and not is_own_puppet \
                 or forbid_own_puppets and is_own_puppet:
-                print(mid)
-                puppet = await p.Puppet.get_by_mxid(user_id)
-                await puppet.intent.leave_room(self.mxid)
+                to_leave.append(leave(user_id))
+        await asyncio.gather(*to_leave)
 
     async def backfill(self, source: 'u.User', info: ChatInfo) -> None:
         try:
@@ -634,9 +774,25 @@ class Portal(DBPortal, BasePortal):
             self.log.debug("Didn't get any messages from server")
         else:
             self.log.debug("Got %d messages from server", len(messages))
+            # Look up the messages & senders in bulk, so that handling each message
+            # finds them in the caches instead of querying them one by one.
+            await DBMessage.get_all_by_mids([evt.id for evt in messages])
+            sender_mids = {evt.sender.id for evt in messages if evt.sender and evt.sender.id}
+            if self.other_user:
+                sender_mids.add(self.other_user)
+            if sender_mids:
+                await p.Puppet.get_all_by_mids(list(sender_mids))
             async with NotificationDisabler(self.mxid, source):
-                for evt in messages:
-                    await self.handle_remote_message(source, evt, handle_receipt=self.is_direct)
+                if not self.is_direct:
+                    await self._update_senders(source, messages)
+                # Messages must be sent in order, but their stickers & emoticons needn't be,
+                # so upload those ahead of time while the messages are being sent.
+                prefetch = self.loop.create_task(self._prefetch_remote_media(source, messages))
+                try:
+                    for evt in messages:
+                        await self.handle_remote_message(source, evt, handle_receipt=self.is_direct)
+                finally:
+                    prefetch.cancel()
             self.log.info("Backfilled %d messages through %s", len(messages), source.mxid)
             await self._cleanup_noid_msgs()
 
@@ -665,6 +821,59 @@ class Portal(DBPortal, BasePortal):
                 await self.handle_remote_receipt(rct)
             self.log.info("Backfilled %d receipts through %s", len(receipts), source.mxid)
 
+    async def _update_senders(self, source: 'u.User', messages: List[Message]) -> None:
+        # Bring every sender's puppet up to date at once, so that handling each message
+        # doesn't have to do it one sender at a time. Their latest info is what sticks.
+        senders = {evt.sender.id: evt.sender for evt in messages
+                   if not evt.is_outgoing and evt.sender and evt.sender.id}
+        sema = asyncio.Semaphore(MEMBER_SYNC_CONCURRENCY)
+
+        async def update(info: Participant) -> None:
+            async with sema:
+                puppet = await p.Puppet.get_by_mid(info.id)
+                await puppet.update_info(info, source.client)
+
+        results = await asyncio.gather(*(update(info) for info in senders.values()),
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.log.warning(f"Failed to update sender info in chat {self.chat_id}: {result}")
+
+    async def _prefetch_remote_media(self, source: 'u.User', messages: List[Message]) -> None:
+        # Only media that gets deduplicated can be prefetched, as that is stored by its ID
+        # and can be found again by handle_remote_message, regardless of who uploaded it.
+        if self.encrypted or not self.config["bridge.receive_stickers"]:
+            return
+        media = {}
+        for evt in messages:
+            if evt.image and evt.image.url:
+                if evt.image.is_sticker:
+                    media.setdefault(evt.image.url, evt.image.url)
+            elif evt.html:
+                for match in _HTML_TOKEN_RE.finditer(evt.html):
+                    tag, attr_str, _ = match.groups()
+                    if tag and tag.lower() == "img":
+                        attrs = _parse_html_attrs(attr_str)
+                        if "src" in attrs:
+                            src = attrs["src"]
+                            media.setdefault(_emoticon_media_id(attrs) or src, src)
+        if not media:
+            return
+
+        sema = asyncio.Semaphore(MEDIA_PREFETCH_CONCURRENCY)
+
+        async def prefetch(media_id: str, media_url: str) -> None:
+            async with sema:
+                await self._handle_remote_media(source, self.az.intent, media_url, media_id,
+                                                deduplicate=True)
+
+        results = await asyncio.gather(*(prefetch(media_id, media_url)
+                                         for media_id, media_url in media.items()),
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.log.warning(f"Failed to prefetch media for chat {self.chat_id}: {result}")
+
     @property
     def bridge_info_state_key(self) -> str:
         return f"net.miscworks.line://line/{self.chat_id}"
@@ -797,24 +1006,44 @@ class Portal(DBPortal, BasePortal):
 
             await self.update()
             self.log.debug(f"Matrix room created: {self.mxid}")
-            self.by_mxid[self.mxid] = self
             await self.backfill(source, info)
 
         return self.mxid
 
-    async def postinit(self) -> None:
+    def _add_to_cache(self) -> None:
         self.by_chat_id[self.chat_id] = self
+        if self._cached_mxid != self.mxid:
+            # The room may have changed since the portal was cached, so drop the stale mapping
+            self.by_mxid.pop(self._cached_mxid, None)
+            self._cached_mxid = self.mxid
         if self.mxid:
             self.by_mxid[self.mxid] = self
+            self.not_portal_mxids.pop(self.mxid, None)
+
+    def _invalidate(self) -> None:
+        self.by_chat_id.pop(self.chat_id, None)
+        self.by_mxid.pop(self._cached_mxid, None)
+        self._cached_mxid = None
+
+    async def postinit(self) -> None:
         if self.is_direct:
             self.other_user = self.chat_id
             self._main_intent = (await p.Puppet.get_by_mid(self.other_user)).intent
         else:
             self._main_intent = self.az.intent
+        # Only make it visible to lookups once it's usable
+        self._add_to_cache()
+
+    async def insert(self) -> None:
+        await super().insert()
+        self._add_to_cache()
+
+    async def update(self) -> None:
+        await super().update()
+        self._add_to_cache()
 
     async def delete(self) -> None:
-        self.by_chat_id.pop(self.chat_id, None)
-        self.by_mxid.pop(self.mxid, None)
+        self._invalidate()
         await super().delete()
 
     async def save(self) -> None:
@@ -822,14 +1051,9 @@ class Portal(DBPortal, BasePortal):
 
     @classmethod
     async def all_with_room(cls) -> AsyncGenerator['Portal', None]:
-        portals = await super().all_with_room()
         portal: cls
-        for index, portal in enumerate(portals):
-            try:
-                yield cls.by_chat_id[portal.chat_id]
-            except KeyError:
-                await portal.postinit()
-                yield portal
+        async for portal in super().all_with_room():
+            yield await cls._get_shared(portal.chat_id, lambda: cls._postinit_loaded(portal))
 
     @classmethod
     async def get_by_mxid(cls, mxid: RoomID) -> Optional['Portal']:
@@ -837,30 +1061,55 @@ class Portal(DBPortal, BasePortal):
             return cls.by_mxid[mxid]
         except KeyError:
             pass
+        if cls.not_portal_mxids.get(mxid, 0) > time.monotonic():
+            return None
 
         portal = cast(cls, await super().get_by_mxid(mxid))
         if portal is not None:
-            await portal.postinit()
-            return portal
+            return await cls._get_shared(portal.chat_id, lambda: cls._postinit_loaded(portal))
 
+        if len(cls.not_portal_mxids) >= NOT_PORTAL_CACHE_SIZE:
+            cls.not_portal_mxids.clear()
+        cls.not_portal_mxids[mxid] = time.monotonic() + NOT_PORTAL_TTL
         return None
 
     @classmethod
     async def get_by_chat_id(cls, chat_id: str, create: bool = False) -> Optional['Portal']:
+        portal = await cls._get_shared(chat_id, lambda: cls._load(chat_id, create))
+        while portal is None and create:
+            # The load that was already running didn't create missing portals
+            portal = await cls._get_shared(chat_id, lambda: cls._load(chat_id, create))
+        return portal
+
+    @classmethod
+    async def _get_shared(cls, chat_id: str, load: Callable[[], Awaitable[Optional['Portal']]]
+                          ) -> Optional['Portal']:
         try:
             return cls.by_chat_id[chat_id]
         except KeyError:
             pass
+        try:
+            task = cls.loading[chat_id]
+        except KeyError:
+            task = cls.loop.create_task(load())
+            cls.loading[chat_id] = task
+            task.add_done_callback(lambda _: cls.loading.pop(chat_id, None))
+        # Shielded so that one waiter being cancelled doesn't cancel it for the rest
+        return await asyncio.shield(task)
 
+    @classmethod
+    async def _load(cls, chat_id: str, create: bool) -> Optional['Portal']:
         portal = cast(cls, await super().get_by_chat_id(chat_id))
-        if portal is not None:
-            await portal.postinit()
-            return portal
-
-        if create:
+        if portal is None:
+            if not create:
+                return None
             portal = cls(chat_id)
-            await portal.insert()
-            await portal.postinit()
-            return portal
-
-        return None
+            # Insert without caching, as postinit caches it once it's ready
+            await DBPortal.insert(portal)
+        await portal.postinit()
+        return portal
+
+    @staticmethod
+    async def _postinit_loaded(portal: 'Portal') -> 'Portal':
+        await portal.postinit()
+        return portal
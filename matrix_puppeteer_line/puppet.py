@@ -30,6 +30,8 @@ if TYPE_CHECKING:
 
 class Puppet(DBPuppet, BasePuppet):
     by_mid: Dict[str, 'Puppet'] = {}
+    # Bumped on every puppet write, so that cached puppet listings know when to refresh
+    list_version: int = 0
     hs_domain: str
     mxid_template: SimpleTemplate[str]
 
@@ -121,6 +123,14 @@ class Puppet(DBPuppet, BasePuppet):
     def _add_to_cache(self) -> None:
         self.by_mid[self.mid] = self
 
+    async def insert(self) -> None:
+        await super().insert()
+        Puppet.list_version += 1
+
+    async def update(self) -> None:
+        await super().update()
+        Puppet.list_version += 1
+
     async def save(self) -> None:
         await self.update()
 
@@ -163,6 +173,18 @@ class Puppet(DBPuppet, BasePuppet):
 
         return None
 
+    @classmethod
+    async def get_all_by_mids(cls, mids: List[str]) -> List['Puppet']:
+        # Like get_by_mid without creating, but only queries the ones that aren't cached yet
+        puppets = [cls.by_mid[mid] for mid in mids if mid in cls.by_mid]
+        uncached = [mid for mid in mids if mid not in cls.by_mid]
+        if uncached:
+            for puppet in await super().get_all_by_mids(uncached):
+                puppet = cast(cls, puppet)
+                puppet._add_to_cache()
+                puppets.append(puppet)
+        return puppets
+
     @classmethod
     async def get_by_profile(cls, info: Participant, client: Optional[Client] = None) -> 'Puppet':
         stranger = await Stranger.get_by_profile(info)
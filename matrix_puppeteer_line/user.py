@@ -16,6 +16,7 @@
 from typing import Dict, List, Optional, TYPE_CHECKING, cast
 from collections import defaultdict
 import asyncio
+import time
 
 from mautrix.bridge import BaseUser
 from mautrix.types import UserID, RoomID
@@ -26,7 +27,7 @@ from .commands.auth import auto_login
 
 from .db import User as DBUser, Portal as DBPortal, Message as DBMessage, Receipt as DBReceipt
 from .config import Config
-from .rpc import Client, Message, Receipt
+from .rpc import Client, Message, Receipt, StartStatus
 from . import puppet as pu, portal as po
 
 if TYPE_CHECKING:
@@ -48,6 +49,8 @@ class User(DBUser, BaseUser):
 
     _notice_room_lock: asyncio.Lock
     _connection_check_task: Optional[asyncio.Task]
+    _start_status: Optional[StartStatus]
+    _start_status_time: float
 
     def __init__(self, mxid: UserID, notice_room: Optional[RoomID] = None) -> None:
         super().__init__(mxid=mxid, notice_room=notice_room)
@@ -60,6 +63,8 @@ class User(DBUser, BaseUser):
         self.client = None
         self.intent = None
         self.is_syncing = False
+        self._start_status = None
+        self._start_status_time = 0
 
     @classmethod
     def init_cls(cls, bridge: 'MessagesBridge') -> None:
@@ -81,6 +86,18 @@ class User(DBUser, BaseUser):
     async def get_own_puppet(self) -> 'pu.Puppet':
         return await pu.Puppet.get_by_mid(self.own_id)
 
+    # Reuse the status of a recent start, to not round-trip to Puppeteer for back-to-back commands
+    async def start_status(self, max_age: float = 2.0) -> StartStatus:
+        if self._start_status and time.monotonic() - self._start_status_time < max_age:
+            return self._start_status
+        status = await self.client.start()
+        self._start_status = status
+        self._start_status_time = time.monotonic()
+        return status
+
+    def clear_start_status(self) -> None:
+        self._start_status = None
+
     async def is_logged_in(self) -> bool:
         try:
             return self.client and (await self.client.start()).is_logged_in
@@ -108,6 +125,7 @@ class User(DBUser, BaseUser):
     async def connect(self) -> None:
         self.loop.create_task(self.connect_double_puppet())
         self.client = Client(self.mxid, self.own_id, self.config["appservice.ephemeral_events"])
+        self.clear_start_status()
         self.log.debug("Starting client")
         await self.send_bridge_notice("Starting up...")
         state = await self.client.start()
@@ -205,7 +223,7 @@ class User(DBUser, BaseUser):
     async def get_direct_chats(self) -> Dict[UserID, List[RoomID]]:
         return {
             pu.Puppet.get_mxid_from_id(portal.other_user): [portal.mxid]
-            for portal in await DBPortal.find_private_chats()
+            async for portal in DBPortal.find_private_chats()
             if portal.mxid
         }
 
@@ -230,6 +248,7 @@ class User(DBUser, BaseUser):
         await portal.handle_remote_receipt(receipt)
 
     async def handle_logged_out(self, message: str) -> None:
+        self.clear_start_status()
         if self._connection_check_task:
             self._connection_check_task.cancel()
             self._connection_check_task = None
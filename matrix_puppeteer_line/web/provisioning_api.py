@@ -13,7 +13,8 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Awaitable, Dict, Optional
+from typing import Awaitable, Mapping, Optional, Set
+from types import MappingProxyType
 import logging
 import asyncio
 
@@ -24,31 +25,41 @@ from mautrix.util.logging import TraceLogger
 
 from .. import user as u
 
+_WS_AUTH_PREFIX = "net.miscworks.line.auth-"
+
+# Error bodies are constant, so encode them once instead of on every rejected request
+_ERR_MISSING_AUTH = b'{"error": "Missing Authorization header"}'
+_ERR_MALFORMED_AUTH = b'{"error": "Malformed Authorization header"}'
+_ERR_INVALID_TOKEN = b'{"error": "Invalid token"}'
+_ERR_MISSING_USER_ID = b'{"error": "Missing user_id query param"}'
+_ERR_ALREADY_LOGGED_IN = b'{"error": "Already logged in"}'
+
 
 class ProvisioningAPI:
     log: TraceLogger = logging.getLogger("mau.web.provisioning")
     app: web.Application
 
+    _acao_headers: Mapping[str, str]
+    _headers: Mapping[str, str]
+    _sync_tasks: Set[asyncio.Task]
+
     def __init__(self, shared_secret: str) -> None:
         self.app = web.Application()
         self.shared_secret = shared_secret
+        self._sync_tasks = set()
         self.app.router.add_get("/api/whoami", self.status)
         self.app.router.add_get("/api/login", self.login)
 
-    @property
-    def _acao_headers(self) -> Dict[str, str]:
-        return {
+        # Read-only so that they can be safely shared by every response
+        self._acao_headers = MappingProxyType({
             "Access-Control-Allow-Origin": "*",
             "Access-Control-Allow-Headers": "Authorization, Content-Type",
             "Access-Control-Allow-Methods": "GET",
-        }
-
-    @property
-    def _headers(self) -> Dict[str, str]:
-        return {
+        })
+        self._headers = MappingProxyType({
             **self._acao_headers,
             "Content-Type": "application/json",
-        }
+        })
 
     async def login_options(self, _: web.Request) -> web.Response:
         return web.Response(status=200, headers=self._headers)
@@ -59,14 +70,19 @@ class ProvisioningAPI:
             return None
 
         try:
-            auth_parts = request.headers["Sec-WebSocket-Protocol"].split(",")
+            protocols = request.headers["Sec-WebSocket-Protocol"]
         except KeyError:
             return None
-        for part in auth_parts:
-            part = part.strip()
-            if part.startswith("net.miscworks.line.auth-"):
-                return part[len("net.miscworks.line.auth-"):]
-        return None
+        # Sec-WebSocket-Protocol is a comma-separated list, so only accept the prefix at the
+        # start of an entry
+        start = protocols.find(_WS_AUTH_PREFIX)
+        while start > 0 and protocols[:start].rstrip()[-1:] not in ("", ","):
+            start = protocols.find(_WS_AUTH_PREFIX, start + 1)
+        if start < 0:
+            return None
+        start += len(_WS_AUTH_PREFIX)
+        end = protocols.find(",", start)
+        return protocols[start:end if end >= 0 else None].strip()
 
     def check_token(self, request: web.Request) -> Awaitable['u.User']:
         try:
@@ -75,18 +91,15 @@ class ProvisioningAPI:
         except KeyError:
             token = self._get_ws_token(request)
             if not token:
-                raise web.HTTPBadRequest(text='{"error": "Missing Authorization header"}',
-                                         headers=self._headers)
+                raise web.HTTPBadRequest(body=_ERR_MISSING_AUTH, headers=self._headers)
         except IndexError:
-            raise web.HTTPBadRequest(text='{"error": "Malformed Authorization header"}',
-                                     headers=self._headers)
+            raise web.HTTPBadRequest(body=_ERR_MALFORMED_AUTH, headers=self._headers)
         if token != self.shared_secret:
-            raise web.HTTPForbidden(text='{"error": "Invalid token"}', headers=self._headers)
+            raise web.HTTPForbidden(body=_ERR_INVALID_TOKEN, headers=self._headers)
         try:
             user_id = request.query["user_id"]
         except KeyError:
-            raise web.HTTPBadRequest(text='{"error": "Missing user_id query param"}',
-                                     headers=self._headers)
+            raise web.HTTPBadRequest(body=_ERR_MISSING_USER_ID, headers=self._headers)
 
         return u.User.get_by_mxid(UserID(user_id))
 
@@ -105,7 +118,7 @@ class ProvisioningAPI:
 
         status = await user.client.start()
         if status.is_logged_in:
-            raise web.HTTPConflict(text='{"error": "Already logged in"}', headers=self._headers)
+            raise web.HTTPConflict(body=_ERR_ALREADY_LOGGED_IN, headers=self._headers)
 
         ws = web.WebSocketResponse(protocols=["net.miscworks.line.login"])
         await ws.prepare(request)
@@ -118,6 +131,15 @@ class ProvisioningAPI:
             self.log.exception("Error logging in")
         else:
             await ws.send_json({"success": True})
-            asyncio.create_task(user.sync())
+            # Keep a reference so the sync isn't garbage-collected before it finishes
+            task = asyncio.create_task(self._sync(user))
+            self._sync_tasks.add(task)
+            task.add_done_callback(self._sync_tasks.discard)
         await ws.close()
         return ws
+
+    async def _sync(self, user: 'u.User') -> None:
+        try:
+            await user.sync()
+        except Exception:
+            self.log.exception("Failed to sync after login")